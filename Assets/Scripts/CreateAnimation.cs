@@ -19,6 +19,7 @@ public class CreateAnimation : MonoBehaviour
 
 	private float[][] _translations;
 	private float[][][] _poses;
+	private float[] _sourceFrames;
 	private Transform _avatarTransform;
 	private SMPLBlendshapes _blendshapes;
 	private AnimationRecorder _animRecorder;
@@ -49,27 +50,33 @@ public class CreateAnimation : MonoBehaviour
 	private void GetJSONInformation()
 	{
 		float[] averageShape = new float[10];
-		_translations = new float[_videoNumberOfFrames][];
-		_poses = new float[_videoNumberOfFrames][][];
-		for(int frameIndex = 0; frameIndex < _videoNumberOfFrames; frameIndex++)
+		string binaryPath = Application.dataPath + "/../Python/ThirdParty/hmr/results/animation.bin";
+		if (File.Exists (binaryPath))
+			GetBinaryInformation (binaryPath, averageShape);
+		else
 		{
-			_translations[frameIndex] = new float[3];
-			_poses[frameIndex] = new float[24][];
-			using (StreamReader reader = new StreamReader (Application.dataPath + "/../Python/ThirdParty/hmr/results/" + frameIndex.ToString() + ".json"))
+			_translations = new float[_videoNumberOfFrames][];
+			_poses = new float[_videoNumberOfFrames][][];
+			for(int frameIndex = 0; frameIndex < _videoNumberOfFrames; frameIndex++)
 			{
-				string text = reader.ReadToEnd ();
-				reader.Close ();
-				JSONNode node = JSON.Parse (text);
-				for (int i = 0; i < 10; i++)
-					averageShape [i] += node ["shape"] [i].AsFloat / _videoNumberOfFrames;
-				for (int i = 0; i < 3; i++)
-					_translations [frameIndex] [i] = node ["translation"] [i].AsFloat;
-				_translations [frameIndex] [0] = -Mathf.Abs (_translations [frameIndex] [0]);
-				for (int i = 0; i < 24; i++) 
+				_translations[frameIndex] = new float[3];
+				_poses[frameIndex] = new float[24][];
+				using (StreamReader reader = new StreamReader (Application.dataPath + "/../Python/ThirdParty/hmr/results/" + frameIndex.ToString() + ".json"))
 				{
-					_poses [frameIndex] [i] = new float[4];
-					for (int j = 0; j < 4; j++)
-						_poses [frameIndex] [i] [j] = node ["pose"] [i] [j].AsFloat;
+					string text = reader.ReadToEnd ();
+					reader.Close ();
+					JSONNode node = JSON.Parse (text);
+					for (int i = 0; i < 10; i++)
+						averageShape [i] += node ["shape"] [i].AsFloat / _videoNumberOfFrames;
+					for (int i = 0; i < 3; i++)
+						_translations [frameIndex] [i] = node ["translation"] [i].AsFloat;
+					_translations [frameIndex] [0] = -Mathf.Abs (_translations [frameIndex] [0]);
+					for (int i = 0; i < 24; i++) 
+					{
+						_poses [frameIndex] [i] = new float[4];
+						for (int j = 0; j < 4; j++)
+							_poses [frameIndex] [i] [j] = node ["pose"] [i] [j].AsFloat;
+					}
 				}
 			}
 		}
@@ -87,6 +94,47 @@ public class CreateAnimation : MonoBehaviour
 		}
 	}
 
+	//////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+	// Reads the whole clip from the binary file written by hmr/demo.py (see hmr/src/util/animation.py)
+	private void GetBinaryInformation(string path, float[] averageShape)
+	{
+		using (BinaryReader reader = new BinaryReader (File.OpenRead (path)))
+		{
+			if (new string (reader.ReadChars (4)) != "HMRA" || reader.ReadUInt32 () != 1)
+				throw new InvalidDataException (path + " is not a version 1 animation file");
+			_videoNumberOfFrames = (int)reader.ReadUInt32 ();
+			int numberOfJoints = (int)reader.ReadUInt32 ();
+			int numberOfBetas = (int)reader.ReadUInt32 ();
+			reader.ReadBytes (12);
+			_translations = new float[_videoNumberOfFrames][];
+			_poses = new float[_videoNumberOfFrames][][];
+			_sourceFrames = new float[_videoNumberOfFrames];
+			for (int frameIndex = 0; frameIndex < _videoNumberOfFrames; frameIndex++)
+			{
+				_sourceFrames [frameIndex] = reader.ReadSingle ();
+				_translations [frameIndex] = new float[3];
+				for (int i = 0; i < 3; i++)
+					_translations [frameIndex] [i] = reader.ReadSingle ();
+				_translations [frameIndex] [0] = -Mathf.Abs (_translations [frameIndex] [0]);
+				_poses [frameIndex] = new float[numberOfJoints][];
+				for (int i = 0; i < numberOfJoints; i++)
+				{
+					_poses [frameIndex] [i] = new float[4];
+					for (int j = 0; j < 4; j++)
+						_poses [frameIndex] [i] [j] = reader.ReadSingle ();
+				}
+				for (int i = 0; i < numberOfBetas; i++)
+				{
+					float beta = reader.ReadSingle ();
+					if (i < averageShape.Length)
+						averageShape [i] += beta;
+				}
+			}
+		}
+		for (int i = 0; i < averageShape.Length; i++)
+			averageShape [i] /= Mathf.Max (_videoNumberOfFrames, 1);
+	}
+
 	//////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
 	private IEnumerator SetAvatarPoseCoroutine(int frameIndex)
 	{
@@ -111,7 +159,11 @@ public class CreateAnimation : MonoBehaviour
 		for (int i = 0; i < _videoNumberOfFrames; i++) 
 		{
 			yield return StartCoroutine (SetAvatarPoseCoroutine (i));
-			_animRecorder.RecordObjectPose(_videoFrameSkip*i/_videoFPS);
+			// the binary file gives the source frame of each pose, which may not be evenly spaced
+			if (_sourceFrames != null)
+				_animRecorder.RecordObjectPose((_sourceFrames[i] - _sourceFrames[0])/_videoFPS);
+			else
+				_animRecorder.RecordObjectPose(_videoFrameSkip*i/_videoFPS);
 		}
 		_animRecorder.SaveOutputToClip ("Assets/Resources/Animation/" + _animationName + ".anim", null);
 	}
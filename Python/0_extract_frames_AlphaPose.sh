@@ -1,5 +1,2 @@
-mkdir Temp
-ffmpeg -y -i inputVideo.mp4 -vf "select=not(mod(n\,10))" -vsync vfr Temp/temp%03d.png
-rm -r ThirdParty/AlphaPosePytorch/results/*
-ffmpeg -y -framerate 10 -i Temp/temp%03d.png ThirdParty/AlphaPosePytorch/results/extractedFramesVideo.mp4
-rm -r Temp
+# results/ is kept between runs, its manifest.jsonl and framestore/ let
+# 1_get_character_AlphaPose.sh resume, pass --restart to video_demo.py to start over
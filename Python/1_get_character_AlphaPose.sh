@@ -1,6 +1,6 @@
 . /media/greg/Data/anaconda2/etc/profile.d/conda.sh
 conda activate py3env-pytorch
 cd ThirdParty/AlphaPosePytorch
-python3 video_demo.py --video results/extractedFramesVideo.mp4 --outdir results --save_img --save_video --format cmu
+python3 video_demo.py --video ../../inputVideo.mp4 --frame_stride 10 --outdir results --save_img --save_video --framestore --format cmu
 rm -r ../densepose/input_data/*
-mv results/vis/* ../densepose/input_data/
+cp results/vis/* ../densepose/input_data/
@@ -1,11 +1,17 @@
 cd ThirdParty/densepose
-rm -r results/*
+CFG=configs/DensePose_ResNet101_FPN_s1x-e2e.yaml
+WTS=DensePoseData/weights/DensePose_ResNet101_FPN_s1x-e2e.pkl
+# frames processed with another config or weights are processed again
+python2 ../AlphaPosePytorch/checkpoint.py pending results input_data input_pending --params $CFG,$WTS
+# the texture is accumulated from the results as DensePose writes them
+python2 get_texture.py --workers 0 --fusion weighted --follow &
 sudo service docker start
 sudo nvidia-docker run --rm -v /media/greg/Data/ownCloud/Unity/360Pose/Python/ThirdParty/densepose:/denseposedata -it densepose:c2-cuda9-cudnn7-wdata \
 python2 tools/infer_simple.py \
---cfg configs/DensePose_ResNet101_FPN_s1x-e2e.yaml \
+--cfg $CFG \
 --output-dir "DensePoseData/results/" \
 --image-ext png \
---wts "DensePoseData/weights/DensePose_ResNet101_FPN_s1x-e2e.pkl" \
-"DensePoseData/input_data/"
-python2 get_texture.py
+--wts "$WTS" \
+"DensePoseData/input_pending/"
+python2 ../AlphaPosePytorch/checkpoint.py record results input_data --params $CFG,$WTS
+wait
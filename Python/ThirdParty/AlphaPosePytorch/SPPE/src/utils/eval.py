@@ -4,6 +4,7 @@ try:
 except ImportError:
     from SPPE.src.utils.img import transformBoxInvert, transformBoxInvert_batch
 import torch
+import numpy as np
 
 
 class DataLogger(object):
@@ -147,51 +148,87 @@ def getPrediction(hms, pt1, pt2, inpH, inpW, resH, resW):
     return preds, preds_tf, maxval
 
 
-def getPrediction_batch(hms, pt1, pt2, inpH, inpW, resH, resW):
+def getPrediction_batch(hms, pt1, pt2, inpH, inpW, resH, resW, refine='sign'):
     '''
-    Get keypoint location from heatmaps
+    Get keypoint location from heatmaps, vectorized over people and joints
+    hms:        [n, 17, resH, resW] torch Tensor or numpy array
     pt1, pt2:   [n, 2]
+    refine:     'sign'   -- quarter pixel step towards the higher neighbour (same as getPrediction)
+                'taylor' -- vertex of the per-axis quadratic through the peak and its neighbours
+                None     -- integer peak
     OUTPUT:
         preds:  [n, 17, 2]
+    Outputs are numpy arrays when hms is a numpy array.
     '''
+    is_numpy = isinstance(hms, np.ndarray)
+    hms = torch.as_tensor(hms).float()
+    pt1 = torch.as_tensor(pt1).float()
+    pt2 = torch.as_tensor(pt2).float()
 
     assert hms.dim() == 4, 'Score maps should be 4-dim'
-    flat_hms = hms.view(hms.size(0), hms.size(1), -1)
+    height, width = hms.size(2), hms.size(3)
+    flat_hms = hms.reshape(hms.size(0), hms.size(1), -1)
     maxval, idx = torch.max(flat_hms, 2)
 
     maxval = maxval.view(hms.size(0), hms.size(1), 1)
-    idx = idx.view(hms.size(0), hms.size(1), 1) + 1
+    idx = idx.view(hms.size(0), hms.size(1), 1)
+
+    pred_x = (idx % width).float()
+    pred_y = torch.floor(idx.float() / width)
+
+    pred_mask = maxval.gt(0).float()
+    pred_x *= pred_mask
+    pred_y *= pred_mask
+
+    if refine is not None:
+        # Only peaks with all four neighbours inside the map are refined
+        inside = (pred_x > 0) & (pred_x < width - 1) & (pred_y > 0) & (pred_y < height - 1)
+        center = (pred_y * width + pred_x).long()
+        neighbours = torch.cat((center - 1, center + 1, center - width, center + width), 2)
+        neighbours = neighbours.clamp(0, flat_hms.size(2) - 1)
+        left, right, up, down = flat_hms.gather(2, neighbours).split(1, dim=2)
+
+        if refine == 'sign':
+            diff_x = (right - left).sign() * 0.25
+            diff_y = (down - up).sign() * 0.25
+        elif refine == 'taylor':
+            peak = flat_hms.gather(2, center)
+            dxx = left + right - 2 * peak
+            dyy = up + down - 2 * peak
+            # Offset of the parabola vertex, 0 where the peak is not a local maximum
+            diff_x = torch.where(dxx < 0, -0.5 * (right - left) / dxx.clamp(max=-1e-12), torch.zeros_like(dxx))
+            diff_y = torch.where(dyy < 0, -0.5 * (down - up) / dyy.clamp(max=-1e-12), torch.zeros_like(dyy))
+            diff_x = diff_x.clamp(-0.5, 0.5)
+            diff_y = diff_y.clamp(-0.5, 0.5)
+        else:
+            raise ValueError('Unknown refinement: %s' % refine)
+
+        inside = inside.float()
+        pred_x += diff_x * inside
+        pred_y += diff_y * inside
+
+    preds = torch.cat((pred_x, pred_y), 2)
 
-    preds = idx.repeat(1, 1, 2).float()
-
-    preds[:, :, 0] = (preds[:, :, 0] - 1) % hms.size(3)
-    preds[:, :, 1] = torch.floor((preds[:, :, 1] - 1) / hms.size(3))
-
-    pred_mask = maxval.gt(0).repeat(1, 1, 2).float()
-    preds *= pred_mask
-
-    # Very simple post-processing step to improve performance at tight PCK thresholds
-    idx_up = (idx - hms.size(3)).clamp(0, flat_hms.size(2) - 1)
-    idx_down = (idx + hms.size(3)).clamp(0, flat_hms.size(2) - 1)
-    idx_left = (idx - 1).clamp(0, flat_hms.size(2) - 1)
-    idx_right = (idx + 1).clamp(0, flat_hms.size(2) - 1)
-
-    maxval_up = flat_hms.gather(2, idx_up)
-    maxval_down = flat_hms.gather(2, idx_down)
-    maxval_left = flat_hms.gather(2, idx_left)
-    maxval_right = flat_hms.gather(2, idx_right)
-
-    diff1 = (maxval_right - maxval_left).sign() * 0.25
-    diff2 = (maxval_down - maxval_up).sign() * 0.25
-    diff1[idx_up <= hms.size(3)] = 0
-    diff1[idx_down / hms.size(3) >= (hms.size(3) - 1)] = 0
-    diff2[(idx_left % hms.size(3)) == 0] = 0
-    diff2[(idx_left % hms.size(3)) == (hms.size(3) - 1)] = 0
-
-    preds[:, :, 0] += diff1.squeeze(-1)
-    preds[:, :, 1] += diff2.squeeze(-1)
-
-    preds_tf = torch.zeros(preds.size())
     preds_tf = transformBoxInvert_batch(preds, pt1, pt2, inpH, inpW, resH, resW)
 
+    if is_numpy:
+        return preds.numpy(), preds_tf.numpy(), maxval.numpy()
     return preds, preds_tf, maxval
+
+
+def compare_getPrediction(n=8, nJoints=17, resH=80, resW=64, inpH=320, inpW=256, seed=0):
+    '''
+    Check getPrediction_batch against the per-keypoint loop of getPrediction
+    '''
+    torch.manual_seed(seed)
+    hms = torch.rand(n, nJoints, resH, resW) - 0.1
+    # Put some peaks on the borders and some maps below zero
+    hms[0, 0, 0, 5] = 2
+    hms[0, 1, resH - 1, resW - 1] = 2
+    hms[0, 2, 10, 0] = 2
+    hms[1, 3] = -1
+    pt1 = torch.rand(n, 2) * 100
+    pt2 = pt1 + 50 + torch.rand(n, 2) * 200
+    loop = getPrediction(hms, pt1, pt2, inpH, inpW, resH, resW)
+    batch = getPrediction_batch(hms, pt1, pt2, inpH, inpW, resH, resW)
+    return all(torch.allclose(a, b) for a, b in zip(loop, batch))
@@ -0,0 +1,285 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+# Per-frame checkpoints of the pipeline stages (AlphaPose, HMR, DensePose
+# and the texture). Every stage keeps a manifest.jsonl journal in its
+# results directory: a header line with the stage name and the hash of
+# its parameters, then one line per completed frame with the hash of the
+# frame inputs, the output files it wrote (relative to the directory) and
+# optional per-frame data. Lines are appended and flushed as frames
+# complete, so a crash loses at most the frames in flight. A rerun replays
+# the journal and only processes the frames that are missing, whose
+# inputs changed or whose outputs are gone; other parameters invalidate
+# every frame.
+# Kept free of torch/cv2 and Python 2 compatible like framestore.
+
+_version = 1
+_manifestName = 'manifest.jsonl'
+
+
+def jsonDefault(value):
+    # numpy arrays and scalars, torch tensors
+    if hasattr(value, 'cpu'):
+        value = value.cpu().numpy()
+    return np.asarray(value).tolist()
+
+
+def hashItems(*items):
+    '''
+    Content hash (hex sha1) of numpy arrays (memory-mapped ones included),
+    bytes and json-serializable values.
+    '''
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            h.update(str((item.dtype.str, item.shape)).encode('utf-8'))
+            h.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, bytes):
+            h.update(item)
+        else:
+            h.update(json.dumps(item, sort_keys=True, default=jsonDefault).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def hashFile(path, blockSize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fileSignature(path, sampleSize=1 << 20):
+    '''
+    Cheap content hash of a large file such as the source video: its size
+    and its first and last sampleSize bytes.
+    '''
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        h.update(f.read(sampleSize))
+        if size > sampleSize:
+            f.seek(max(sampleSize, size - sampleSize))
+            h.update(f.read(sampleSize))
+    return h.hexdigest()
+
+
+class StageManifest:
+    '''
+    Journal of the frames completed by one stage, frames being identified
+    by a string key (image name or source frame index).
+    restart discards the previous journal.
+    '''
+    def __init__(self, directory, stage, params=None, restart=False):
+        self.directory = directory
+        self.path = os.path.join(directory, _manifestName)
+        self.stage = stage
+        self.paramsHash = hashItems(params if params is not None else {})
+        self.entries = OrderedDict()
+        self.complete = False
+        self.f = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if restart or not self.load():
+            self.reset()
+        else:
+            self.f = open(self.path, 'a')
+
+    def header(self):
+        return {'version': _version, 'stage': self.stage, 'params': self.paramsHash}
+
+    def load(self):
+        # replays the journal, False when it belongs to other parameters
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            lines = f.read().split('\n')
+        try:
+            if json.loads(lines[0]) != self.header():
+                return False
+        except ValueError:
+            return False
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # empty or partially written last line
+                continue
+            if 'complete' in entry:
+                self.complete = entry['complete']
+            elif entry.get('discard'):
+                self.entries.pop(entry['frame'], None)
+                self.complete = False
+            else:
+                self.entries.pop(entry['frame'], None)
+                self.entries[entry['frame']] = entry
+                self.complete = False
+        return True
+
+    def write(self, entry):
+        self.f.write(json.dumps(entry, default=jsonDefault) + '\n')
+        self.f.flush()
+
+    def reset(self):
+        if self.f is not None:
+            self.f.close()
+        self.entries = OrderedDict()
+        self.complete = False
+        self.f = open(self.path, 'w')
+        self.write(self.header())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, frame):
+        return str(frame) in self.entries
+
+    def frames(self):
+        return list(self.entries.keys())
+
+    def get(self, frame):
+        return self.entries.get(str(frame))
+
+    def outputsExist(self, entry):
+        return all(os.path.exists(os.path.join(self.directory, path)) for path in entry['outputs'])
+
+    def isDone(self, frame, inputHash):
+        entry = self.get(frame)
+        return entry is not None and entry['input'] == inputHash and self.outputsExist(entry)
+
+    def record(self, frame, inputHash, outputs=(), data=None):
+        entry = {'frame': str(frame), 'input': inputHash, 'outputs': list(outputs)}
+        if data is not None:
+            entry['data'] = data
+        self.write(entry)
+        self.entries.pop(entry['frame'], None)
+        self.entries[entry['frame']] = entry
+        self.complete = False
+
+    def discard(self, frames):
+        for frame in frames:
+            if str(frame) in self.entries:
+                self.write({'frame': str(frame), 'discard': True})
+                del self.entries[str(frame)]
+                self.complete = False
+
+    def markComplete(self):
+        self.write({'complete': True})
+        self.complete = True
+
+    def compact(self):
+        # rewrites the journal without the superseded lines
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            f.write(json.dumps(self.header()) + '\n')
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, default=jsonDefault) + '\n')
+            if self.complete:
+                f.write(json.dumps({'complete': True}) + '\n')
+        self.f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmpPath, self.path)
+        self.f = open(self.path, 'a')
+
+    def close(self):
+        if self.f is not None:
+            self.compact()
+            self.f.close()
+            self.f = None
+
+
+def outputNames(name, patterns):
+    stem = os.path.splitext(name)[0]
+    return [pattern.format(name=name, stem=stem) for pattern in patterns]
+
+
+def stageParams(values):
+    '''
+    Parameters of a directory based stage from its command line values
+    (config and weights paths...), a value naming an existing file also
+    stands for its content.
+    '''
+    return [(value, fileSignature(value) if os.path.isfile(value) else None) for value in values]
+
+
+def pendingFiles(args):
+    '''
+    Links the input images that have no valid outputs into pendingDir, for
+    tools that process a whole directory (DensePose infer_simple), and
+    removes the stale outputs of the invalidated ones.
+    '''
+    manifest = StageManifest(args.resultsDir, args.stage, stageParams(args.params))
+    if os.path.exists(args.pendingDir):
+        shutil.rmtree(args.pendingDir)
+    os.makedirs(args.pendingDir)
+    names = sorted(os.listdir(args.inputDir))
+    # frames whose input is gone
+    stale = [name for name in manifest.frames() if name not in names]
+    for name in stale:
+        for output in manifest.get(name)['outputs']:
+            if os.path.exists(os.path.join(args.resultsDir, output)):
+                os.remove(os.path.join(args.resultsDir, output))
+    manifest.discard(stale)
+    pending = 0
+    for name in names:
+        if manifest.isDone(name, hashFile(os.path.join(args.inputDir, name))):
+            continue
+        for output in outputNames(name, args.outputs):
+            if os.path.exists(os.path.join(args.resultsDir, output)):
+                os.remove(os.path.join(args.resultsDir, output))
+        src, dst = os.path.join(args.inputDir, name), os.path.join(args.pendingDir, name)
+        try:
+            os.link(src, dst)
+        except (OSError, AttributeError):
+            shutil.copyfile(src, dst)
+        pending += 1
+    manifest.close()
+    print('%s: %d of %d frames to process' % (args.stage, pending, len(names)))
+
+
+def recordFiles(args):
+    # records the input images whose outputs were written
+    manifest = StageManifest(args.resultsDir, args.stage, stageParams(args.params))
+    recorded = 0
+    for name in sorted(os.listdir(args.inputDir)):
+        inputHash = hashFile(os.path.join(args.inputDir, name))
+        outputs = outputNames(name, args.outputs)
+        if manifest.isDone(name, inputHash):
+            continue
+        if all(os.path.exists(os.path.join(args.resultsDir, output)) for output in outputs):
+            manifest.record(name, inputHash, outputs)
+            recorded += 1
+    manifest.close()
+    print('%s: recorded %d frames' % (args.stage, recorded))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Frame checkpoints of directory based stages')
+    parser.add_argument('command', choices=['pending', 'record'])
+    parser.add_argument('resultsDir', help='directory of the stage outputs and manifest')
+    parser.add_argument('inputDir', help='directory of the input images')
+    parser.add_argument('pendingDir', nargs='?', default=None,
+                        help='directory receiving the images to process (pending only)')
+    parser.add_argument('--stage', default='densepose')
+    parser.add_argument('--outputs', default='{stem}_IUV.png,{stem}_INDS.png',
+                        help='comma separated output names of an input image, from {name} and {stem}')
+    parser.add_argument('--params', default='',
+                        help='comma separated parameters of the stage, e.g. its config and weights, '
+                             'the frames recorded with other parameters are processed again')
+    args = parser.parse_args()
+    args.outputs = args.outputs.split(',')
+    args.params = [value for value in args.params.split(',') if value]
+    if args.command == 'pending':
+        if args.pendingDir is None:
+            parser.error('pending needs a pendingDir')
+        pendingFiles(args)
+    else:
+        recordFiles(args)
@@ -8,9 +8,16 @@ from SPPE.src.utils.img import load_image, cropBox, im_to_torch
 from opt import opt
 from yolo.preprocess import prep_image, prep_frame, inp_to_image
 from pPose_nms import pose_nms, write_json
-from SPPE.src.utils.eval import getPrediction
+from SPPE.src.utils.eval import getPrediction_batch
 from yolo.util import write_results, dynamic_write_results
 from yolo.darknet import Darknet
+from pipeline import Pipeline, END
+from framepool import FrameDecoderPool
+from framestore import FrameStoreWriter
+from checkpoint import hashItems
+from framesampler import MotionSampler
+from tracker import SubjectTracker
+from tiling import TileProjector, mergeTileBoxes
 
 import cv2
 import json
@@ -139,8 +146,6 @@ class DetectionLoader:
                                     opt.num_classes, nms=True, nms_conf=opt.nms_thesh)
                 if isinstance(dets, int) or dets.shape[0] == 0:
                     for k in range(len(inp)):
-                        while self.Q.full():
-                            time.sleep(0.2)
                         self.Q.put((inp[k], orig_img[k], im_name[k], None, None))
                     continue
 
@@ -159,8 +164,6 @@ class DetectionLoader:
                 scores = dets[:, 5:6].cpu()
 
             for k in range(len(inp)):
-                while self.Q.full():
-                    time.sleep(0.2)
                 self.Q.put((inp[k], orig_img[k], im_name[k], boxes[dets[:,0]==k], scores[dets[:,0]==k]))
 
     def read(self):
@@ -171,6 +174,66 @@ class DetectionLoader:
         # return queue len
         return self.Q.qsize()
 
+def frame_range(stream, time_range='', stride=1):
+    '''
+    Source frames to process: (start, stop, stride) from a "start:end" range in seconds
+    '''
+    nframes = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = stream.get(cv2.CAP_PROP_FPS)
+    start, stop = 0, nframes
+    if time_range:
+        begin, _, end = time_range.partition(':')
+        if begin:
+            start = min(nframes, max(0, int(round(float(begin) * fps))))
+        if end:
+            stop = min(nframes, max(start, int(round(float(end) * fps))))
+    return start, stop, max(1, int(stride))
+
+
+def result_to_json(result):
+    # pose_nms result of a frame to plain lists, for the checkpoint manifest
+    if result is None:
+        return None
+    return [{
+        'camera_rot': [float(v) for v in human['camera_rot']],
+        'keypoints': np.asarray(human['keypoints']).tolist(),
+        'kp_score': np.asarray(human['kp_score']).tolist(),
+        'proposal_score': float(human['proposal_score']),
+    } for human in result['result']]
+
+
+def result_from_json(name, humans):
+    return {
+        'imgname': name,
+        'result': [{
+            'camera_rot': tuple(human['camera_rot']),
+            'keypoints': torch.FloatTensor(human['keypoints']),
+            'kp_score': torch.FloatTensor(human['kp_score']),
+            'proposal_score': torch.tensor(human['proposal_score']),
+        } for human in humans]
+    }
+
+
+def sample_frames(stream, start, stop, stride=1):
+    '''
+    Yield (index, frame) for every stride-th frame of [start, stop).
+    Skipped frames are grabbed without being retrieved.
+    '''
+    if start:
+        stream.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for i in range(start, stop):
+        if (i - start) % stride:
+            if not stream.grab():
+                return
+            continue
+        (grabbed, frame) = stream.read()
+        # if the `grabbed` boolean is `False`, then we have
+        # reached the end of the video file
+        if not grabbed:
+            return
+        yield i, frame
+
+
 class VideoDetectionLoader:
     def __init__(self, path, batchSize=4, queueSize=256):
         # initialize the file video stream along with the boolean
@@ -184,105 +247,196 @@ class VideoDetectionLoader:
         self.det_model.cuda()
         self.det_model.eval()
 
+        self.path = path
         self.stream = cv2.VideoCapture(path)
         assert self.stream.isOpened(), 'Cannot capture source'
         self.stopped = False
         self.batchSize = batchSize
-        self.datalen = int(self.stream.get(cv2.CAP_PROP_FRAME_COUNT))
-        leftover = 0
-        if (self.datalen) % batchSize:
-            leftover = 1
-        self.num_batches = self.datalen // batchSize + leftover
+        self.queueSize = queueSize
+        self.start_frame, self.stop_frame, self.stride = frame_range(self.stream, opt.time_range, opt.frame_stride)
+        self.datalen = len(range(self.start_frame, self.stop_frame, self.stride))
+        # with adaptive sampling the stride is the step between candidate frames
+        self.sampler = None
+        # frames waiting for the detector, few with adaptive sampling so that the
+        # subject box fed back to the sampler by detect() is recent
+        self.detectQueueSize = 64
+        if opt.adaptive_stride > 0:
+            self.sampler = MotionSampler(opt.motion_thresh, opt.adaptive_stride)
+            self.detectQueueSize = 2 * batchSize
+        # source index of every frame sent down the pipeline, in order
+        self.sourceFrames = []
+        # follow the subject between detections instead of detecting every frame
+        self.tracker = None
+        if opt.det_interval > 1:
+            self.tracker = SubjectTracker(opt.det_interval, opt.track_thresh)
+        # detect on perspective tiles of inp_dim instead of the letterboxed frame
+        self.tiler = None
+        if opt.det_tiles:
+            self.tiler = TileProjector(opt.det_tiles, self.det_inp_dim, opt.tile_fov)
         # initialize the queue used to store frames read from
         # the video file
         self.Q = Queue(maxsize=queueSize)
 
+    def resumeAfter(self, sourceFrame):
+        # continue an interrupted run after the last checkpointed source frame
+        self.start_frame += ((sourceFrame - self.start_frame) // self.stride + 1) * self.stride
+        self.datalen = len(range(self.start_frame, self.stop_frame, self.stride))
+
     def length(self):
+        # upper bound when frames are selected adaptively
         return self.datalen
 
     def len(self):
         return self.Q.qsize()
 
     def start(self):
-        # start a thread to read frames from the file video stream
-        t = Thread(target=self.update, args=())
-        t.daemon = True
-        t.start()
+        # decode and detect in their own threads, results end up in self.Q
+        self.pipeline = Pipeline()
+        self.pipeline.source('decode', self.frames())
+        self.pipeline.add('detect', self.detect, queueSize=self.detectQueueSize, batchSize=self.batchSize)
+        self.pipeline.output(self.Q)
+        self.pipeline.start()
         return self
 
-    def update(self):
-        # keep looping the whole video
-        for i in range(self.num_batches):
-            img = []
-            inp = []
-            orig_img = []
-            im_name = []
-            im_dim_list = []
-            for k in range(i*self.batchSize, min((i +  1)*self.batchSize, self.datalen)):
-                (grabbed, frame) = self.stream.read()
-                # if the `grabbed` boolean is `False`, then we have
-                # reached the end of the video file
-                if not grabbed:
-                    self.stop()
-                    return
-                # process and add the frame to the queue
-                inp_dim = int(opt.inp_dim)
-                img_k, orig_img_k, im_dim_list_k = prep_frame(frame, inp_dim)
-                inp_k = im_to_torch(orig_img_k)
-
-                img.append(img_k)
-                inp.append(inp_k)
-                orig_img.append(orig_img_k)
-                im_dim_list.append(im_dim_list_k)
-
-            with torch.no_grad():
-                ht = inp[0].size(1)
-                wd = inp[0].size(2)
-                # Human Detection
-                img = Variable(torch.cat(img)).cuda()
-                im_dim_list = torch.FloatTensor(im_dim_list).repeat(1,2)
-                im_dim_list = im_dim_list.cuda()
-
-                prediction = self.det_model(img, CUDA=True)
-                # NMS process
-                dets = dynamic_write_results(prediction, opt.confidence,
-                                    opt.num_classes, nms=True, nms_conf=opt.nms_thesh)
-                if isinstance(dets, int) or dets.shape[0] == 0:
-                    for k in range(len(inp)):
-                        while self.Q.full():
-                            time.sleep(0.2)
-                        self.Q.put((inp[k], orig_img[k], None, None))
+    def frames(self):
+        inp_dim = int(opt.inp_dim)
+        if opt.decode_workers > 1:
+            # decode and letterbox in worker processes, frames come back in order
+            pool = FrameDecoderPool(self.path, opt.decode_workers, inp_dim,
+                                    start=self.start_frame, stop=self.stop_frame, stride=self.stride)
+            frames = ((i, orig_img_k, img_k, im_dim_list_k) for i, (img_k, orig_img_k, im_dim_list_k)
+                      in zip(range(self.start_frame, self.stop_frame, self.stride), pool.frames()))
+        else:
+            frames = ((i, frame, None, None) for i, frame
+                      in sample_frames(self.stream, self.start_frame, self.stop_frame, self.stride))
+        if self.sampler is not None:
+            frames = self.sampler.select(frames)
+        # keep looping the sampled frames of the video
+        for i, frame, img_k, im_dim_list_k in frames:
+            if self.stopped:
+                return
+            # process and add the frame to the queue
+            if self.tiler is not None:
+                im_dim_list_k = (frame.shape[1], frame.shape[0])
+            elif img_k is None:
+                img_k, frame, im_dim_list_k = prep_frame(frame, inp_dim)
+            self.sourceFrames.append(i)
+            yield (img_k, im_to_torch(frame), frame, im_dim_list_k)
+
+    def detect(self, batch):
+        img, inp, orig_img, im_dim_list = [list(x) for x in zip(*batch)]
+        if self.tracker is None:
+            dets = self.detectFrames(img, orig_img, im_dim_list)
+            return self.followSubject([(inp[k], orig_img[k]) + dets[k] for k in range(len(inp))])
+        # detect on the scheduled frames only, track the subject on the others
+        plan = self.tracker.schedule(len(inp))
+        scheduled = [k for k in range(len(inp)) if plan[k]]
+        dets = dict(zip(scheduled, self.detectFrames([img[k] for k in scheduled],
+                                                     [orig_img[k] for k in scheduled],
+                                                     [im_dim_list[k] for k in scheduled])))
+        results = []
+        for k in range(len(inp)):
+            if k not in dets and not self.tracker.lost():
+                box, confidence = self.tracker.track(orig_img[k])
+                if confidence >= self.tracker.threshold:
+                    results.append((inp[k], orig_img[k], torch.FloatTensor([box]), torch.FloatTensor([[confidence]])))
                     continue
+            if k not in dets:
+                # an earlier detection found nobody or tracking failed, fall back to the detector
+                dets[k] = self.detectFrames([img[k]], [orig_img[k]], [im_dim_list[k]])[0]
+            boxes, scores = self.tracker.update(orig_img[k], *dets[k])
+            results.append((inp[k], orig_img[k], boxes, scores))
+        return self.followSubject(results)
+
+    def followSubject(self, results):
+        # the sampler measures motion around the subject box of the last detected frame
+        if self.sampler is not None:
+            for inp, orig_img, boxes, scores in reversed(results):
+                if boxes is not None and len(boxes):
+                    self.sampler.box = np.array(boxes[0]).astype(int)
+                    break
+        return results
+
+    def detectFrames(self, img, orig_img, im_dim_list):
+        # (boxes, scores) in frame coordinates for each frame
+        if self.tiler is None:
+            return self.runDetector(img, im_dim_list)
+        if len(orig_img) == 0:
+            return []
+        # the tiles of all the frames go through the detector as one batch
+        tiles = np.concatenate([self.tiler.tiles(frame) for frame in orig_img])
+        tiles = torch.from_numpy(tiles[:, :, :, ::-1].transpose(0, 3, 1, 2).copy()).float().div(255.0)
+        tileDets = self.runDetector([tiles], [(self.tiler.dim, self.tiler.dim)] * len(tiles))
+        results = []
+        for k, frame in enumerate(orig_img):
+            boxes, scores = [], []
+            for t in range(len(self.tiler)):
+                tileBoxes, tileScores = tileDets[k * len(self.tiler) + t]
+                if tileBoxes is not None:
+                    boxes.append(self.tiler.toEquirect(t, tileBoxes.numpy(), frame.shape[1], frame.shape[0]))
+                    scores.append(tileScores.numpy().reshape(-1))
+            if len(boxes) == 0:
+                results.append((None, None))
+                continue
+            boxes, scores = mergeTileBoxes(np.concatenate(boxes), np.concatenate(scores), frame.shape[1])
+            results.append((torch.FloatTensor(boxes), torch.FloatTensor(scores).view(-1, 1)))
+        return results
+
+    def runDetector(self, img, im_dim_list):
+        # (boxes, scores) for each image, (None, None) when nobody was found
+        if len(img) == 0:
+            return []
+        with torch.no_grad():
+            # Human Detection
+            img = Variable(torch.cat(img)).cuda()
+            im_dim_list = torch.FloatTensor(im_dim_list).repeat(1,2)
+            im_dim_list = im_dim_list.cuda()
+
+            prediction = self.det_model(img, CUDA=True)
+            # NMS process
+            dets = dynamic_write_results(prediction, opt.confidence,
+                                opt.num_classes, nms=True, nms_conf=opt.nms_thesh)
+            if isinstance(dets, int) or dets.shape[0] == 0:
+                return [(None, None)] * len(img)
+
+            im_dim_list = torch.index_select(im_dim_list,0, dets[:, 0].long())
+            scaling_factor = torch.min(self.det_inp_dim / im_dim_list, 1)[0].view(-1, 1)
+
+            # coordinate transfer
+            dets[:, [1, 3]] -= (self.det_inp_dim - scaling_factor * im_dim_list[:, 0].view(-1, 1)) / 2
+            dets[:, [2, 4]] -= (self.det_inp_dim - scaling_factor * im_dim_list[:, 1].view(-1, 1)) / 2
+
+            dets[:, 1:5] /= scaling_factor
+            for j in range(dets.shape[0]):
+                dets[j, [1, 3]] = torch.clamp(dets[j, [1, 3]], 0.0, im_dim_list[j, 0])
+                dets[j, [2, 4]] = torch.clamp(dets[j, [2, 4]], 0.0, im_dim_list[j, 1])
+            boxes = dets[:, 1:5].cpu()
+            scores = dets[:, 5:6].cpu()
+            frameIds = dets[:, 0].cpu()
+
+        results = []
+        for k in range(len(img)):
+            mask = frameIds == k
+            if mask.sum() == 0:
+                results.append((None, None))
+            else:
+                results.append((boxes[mask], scores[mask]))
+        return results
 
-                im_dim_list = torch.index_select(im_dim_list,0, dets[:, 0].long())
-                scaling_factor = torch.min(self.det_inp_dim / im_dim_list, 1)[0].view(-1, 1)
-
-                # coordinate transfer
-                dets[:, [1, 3]] -= (self.det_inp_dim - scaling_factor * im_dim_list[:, 0].view(-1, 1)) / 2
-                dets[:, [2, 4]] -= (self.det_inp_dim - scaling_factor * im_dim_list[:, 1].view(-1, 1)) / 2
-
-                dets[:, 1:5] /= scaling_factor
-                for j in range(dets.shape[0]):
-                    dets[j, [1, 3]] = torch.clamp(dets[j, [1, 3]], 0.0, im_dim_list[j, 0])
-                    dets[j, [2, 4]] = torch.clamp(dets[j, [2, 4]], 0.0, im_dim_list[j, 1])
-                boxes = dets[:, 1:5].cpu()
-                scores = dets[:, 5:6].cpu()
-
-            for k in range(len(inp)):
-                while self.Q.full():
-                    time.sleep(0.2)
-                self.Q.put((inp[k], orig_img[k], boxes[dets[:,0]==k], scores[dets[:,0]==k]))
- 
     def videoinfo(self):
-        # indicate the video info
+        # indicate the video info, fps is the rate of the sampled frames
         fourcc=int(self.stream.get(cv2.CAP_PROP_FOURCC))
-        fps=self.stream.get(cv2.CAP_PROP_FPS)
+        fps=self.stream.get(cv2.CAP_PROP_FPS) / self.stride
         frameSize=(int(self.stream.get(cv2.CAP_PROP_FRAME_WIDTH)),int(self.stream.get(cv2.CAP_PROP_FRAME_HEIGHT)))
         return (fourcc,fps,frameSize)
 
     def read(self):
-        # return next frame in the queue
-        return self.Q.get()
+        # return next frame in the queue, None once the video is exhausted
+        item = self.Q.get()
+        if item is END:
+            self.Q.put(END)
+            return None
+        return item
 
     def more(self):
         # return True if there are still frames in the queue
@@ -474,7 +628,8 @@ class VideoLoader:
         self.stream = cv2.VideoCapture(path)
         assert self.stream.isOpened(), 'Cannot capture source'
         self.stopped = False
-        self.datalen = int(self.stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.start_frame, self.stop_frame, self.stride = frame_range(self.stream, opt.time_range, opt.frame_stride)
+        self.datalen = len(range(self.start_frame, self.stop_frame, self.stride))
         # initialize the queue used to store frames read from
         # the video file
         self.Q = Queue(maxsize=queueSize)
@@ -490,34 +645,25 @@ class VideoLoader:
         return self
 
     def update(self):
-        # keep looping infinitely
-        while True:
-            time.sleep(0.02)
+        # keep looping the sampled frames of the video
+        for _, frame in sample_frames(self.stream, self.start_frame, self.stop_frame, self.stride):
             # if the thread indicator variable is set, stop the
             # thread
             if self.stopped:
                 return
-            # otherwise, ensure the queue has room in it
-            if not self.Q.full():
-                # read the next frame from the file
-                (grabbed, frame) = self.stream.read()
-                # if the `grabbed` boolean is `False`, then we have
-                # reached the end of the video file
-                if not grabbed:
-                    self.stop()
-                    return
-                # process and add the frame to the queue
-                inp_dim = int(opt.inp_dim)
-                img, orig_img, dim = prep_frame(frame, inp_dim)
-                inp = im_to_torch(orig_img)
-                im_dim_list = torch.FloatTensor([dim]).repeat(1, 2)
+            # process and add the frame to the queue, put blocks while it is full
+            inp_dim = int(opt.inp_dim)
+            img, orig_img, dim = prep_frame(frame, inp_dim)
+            inp = im_to_torch(orig_img)
+            im_dim_list = torch.FloatTensor([dim]).repeat(1, 2)
 
-                self.Q.put((img, orig_img, inp, im_dim_list))
+            self.Q.put((img, orig_img, inp, im_dim_list))
+        self.stop()
 
     def videoinfo(self):
-        # indicate the video info
+        # indicate the video info, fps is the rate of the sampled frames
         fourcc=int(self.stream.get(cv2.CAP_PROP_FOURCC))
-        fps=self.stream.get(cv2.CAP_PROP_FPS)
+        fps=self.stream.get(cv2.CAP_PROP_FPS) / self.stride
         frameSize=(int(self.stream.get(cv2.CAP_PROP_FRAME_WIDTH)),int(self.stream.get(cv2.CAP_PROP_FRAME_HEIGHT)))
         return (fourcc,fps,frameSize)
 
@@ -537,7 +683,7 @@ class VideoLoader:
 class DataWriter:
     def __init__(self, save_video=False,
                 savepath='examples/res/1.avi', fourcc=cv2.VideoWriter_fourcc(*'XVID'), fps=25, frameSize=(640,480),
-                queueSize=1024):
+                queueSize=1024, storeInfo=None, sourceFrames=None, manifest=None, resumeFrames=0):
         if save_video:
             # initialize the file video stream along with the boolean
             # used to indicate if the thread should be stopped or not
@@ -546,79 +692,102 @@ class DataWriter:
         self.save_video = save_video
         self.stopped = False
         self.final_result = []
-        # initialize the queue used to store frames read from
-        # the video file
-        self.Q = Queue(maxsize=queueSize)
+        self.queueSize = queueSize
+        self.pipeline = None
+        self.store = None
+        # source frame index of the k-th written frame, filled by the loader
+        self.sourceFrames = sourceFrames
+        self.written = 0
+        # every written frame is recorded in the checkpoint manifest, with its
+        # pose results so that a resumed run can write the complete json
+        self.manifest = manifest
+        if manifest is not None:
+            for name in manifest.frames()[:resumeFrames]:
+                humans = manifest.get(name).get('data')
+                if humans is not None:
+                    self.final_result.append(result_from_json(name, humans))
+        if opt.framestore:
+            self.store = FrameStoreWriter(os.path.join(opt.outputpath, 'framestore'), opt.framestore_chunk, storeInfo,
+                                          keep=resumeFrames)
         if opt.save_img:
             if not os.path.exists(opt.outputpath + '/vis'):
                 os.mkdir(opt.outputpath + '/vis')
 
     def start(self):
-        # start a thread to read frames from the file video stream
-        t = Thread(target=self.update, args=())
-        t.daemon = True
-        t.start()
+        # pose NMS and writing run in their own threads, fed by save()
+        self.pipeline = Pipeline()
+        self.pipeline.add('nms', self.postprocess, queueSize=self.queueSize)
+        self.pipeline.add('write', self.write)
+        self.pipeline.start()
         return self
 
-    def update(self):
-        # keep looping infinitely
-        while True:
-            # if the thread indicator variable is set, stop the
-            # thread
-            if self.stopped:
-                if self.save_video:
-                    self.stream.release()
-                return
-            # otherwise, ensure the queue is not empty
-            if not self.Q.empty():
-                (boxes, scores, hm_data, pt1, pt2, orig_img, im_name, rot) = self.Q.get()
-                orig_img = np.array(orig_img, dtype=np.uint8)
-                if boxes is None:
-                    if opt.save_img or opt.save_video or opt.vis:
-                        img = orig_img
-                        if opt.vis:
-                            cv2.imshow("AlphaPose Demo", img)
-                            cv2.waitKey(30)
-                        if opt.save_img:
-                            cv2.imwrite(os.path.join(opt.outputpath, 'vis', im_name), img)
-                        if opt.save_video:
-                            self.stream.write(img)
-                else:
-                    # location prediction (n, kp, 2) | score prediction (n, kp, 1)
-                    hm_data = hm_data.cpu().data
-                    preds_hm, preds_img, preds_scores = getPrediction(
-                        hm_data, pt1, pt2, opt.inputResH, opt.inputResW, opt.outputResH, opt.outputResW)
-                    result = pose_nms(boxes, scores, preds_img, preds_scores, rot)
-                    result = {
-                        'imgname': im_name,
-                        'result': result
-                    }
-                    self.final_result.append(result)
-                    if opt.save_img or opt.save_video or opt.vis:
-                        img = vis_frame(orig_img, result)
-                        if opt.vis:
-                            cv2.imshow("AlphaPose Demo", img)
-                            cv2.waitKey(30)
-                        if opt.save_img:
-                            cv2.imwrite(os.path.join(opt.outputpath, 'vis', im_name), img)
-                        if opt.save_video:
-                            self.stream.write(img)
+    def postprocess(self, item):
+        (boxes, scores, hm_data, pt1, pt2, orig_img, im_name, rot) = item
+        orig_img = np.array(orig_img, dtype=np.uint8)
+        if boxes is None:
+            return (orig_img, im_name, rot, None, None)
+        # location prediction (n, kp, 2) | score prediction (n, kp, 1)
+        hm_data = hm_data.cpu().data
+        preds_hm, preds_img, preds_scores = getPrediction_batch(
+            hm_data, pt1, pt2, opt.inputResH, opt.inputResW, opt.outputResH, opt.outputResW,
+            refine=None if opt.kp_refine == 'none' else opt.kp_refine)
+        result = pose_nms(boxes, scores, preds_img, preds_scores, rot)
+        result = {
+            'imgname': im_name,
+            'result': result
+        }
+        self.final_result.append(result)
+        return (orig_img, im_name, rot, boxes, result)
+
+    def write(self, item):
+        (orig_img, im_name, rot, boxes, result) = item
+        source = self.sourceFrames[self.written] if self.sourceFrames is not None else None
+        if self.store is not None:
+            # clean crop, keypoints are kept as metadata instead of being drawn
+            keypoints = None
+            if result is not None and result['result']:
+                keypoints = torch.stack([torch.cat((human['keypoints'], human['kp_score']), 1) for human in result['result']])
+            self.store.append(orig_img, im_name, rot, boxes, keypoints, source)
+        self.written += 1
+        if opt.save_img or opt.save_video or opt.vis:
+            if result is None:
+                img = orig_img
             else:
-                time.sleep(0.1)
+                img = vis_frame(orig_img, result)
+            if opt.vis:
+                cv2.imshow("AlphaPose Demo", img)
+                cv2.waitKey(30)
+            if opt.save_img:
+                cv2.imwrite(os.path.join(opt.outputpath, 'vis', im_name), img)
+            if opt.save_video:
+                self.stream.write(img)
+        if self.manifest is not None:
+            outputs = [os.path.join('vis', im_name)] if opt.save_img else []
+            self.manifest.record(im_name, hashItems(source), outputs, result_to_json(result))
 
     def running(self):
         # indicate that the thread is still running
-        time.sleep(0.2)
-        return not self.Q.empty()
+        return self.pipeline is not None and self.pipeline.running()
 
     def save(self, boxes, scores, hm_data, pt1, pt2, orig_img, im_name, rot):
-        # save next frame in the queue
-        self.Q.put((boxes, scores, hm_data, pt1, pt2, orig_img, im_name, rot))
+        # save next frame in the queue, blocks while the queue is full
+        self.pipeline.put((boxes, scores, hm_data, pt1, pt2, orig_img, im_name, rot))
 
     def stop(self):
-        # indicate that the thread should be stopped
-        self.stopped = True
-        time.sleep(0.2)
+        # flush the queue and wait for the writer threads to finish
+        if not self.stopped:
+            self.stopped = True
+            if self.pipeline is not None:
+                self.pipeline.close()
+                self.pipeline.join()
+            self.release()
+
+    def release(self):
+        if self.save_video:
+            self.stream.release()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
 
     def results(self):
         # return final result
@@ -626,7 +795,7 @@ class DataWriter:
 
     def len(self):
         # return queue len
-        return self.Q.qsize()
+        return sum(stage.Q.qsize() for stage in self.pipeline.stages) if self.pipeline else 0
 
 class Mscoco(data.Dataset):
     def __init__(self, train=True, sigma=1,
@@ -0,0 +1,150 @@
+import traceback
+import multiprocessing as mp
+
+import cv2
+import numpy as np
+import torch
+
+from yolo.preprocess import letterbox_image
+
+
+def frame_runs(start, stop, stride, numWorkers, runLength):
+    '''
+    Source frame ranges [first, last) of runLength consecutive sampled frames
+    of range(start, stop, stride), dealt round-robin to the workers.
+    '''
+    sampled = range(start, stop, stride)
+    runs = [(sampled[k], min(stop, sampled[k] + runLength * stride)) for k in range(0, len(sampled), runLength)]
+    return [runs[w::numWorkers] for w in range(numWorkers)]
+
+
+def frame_runs(start, stop, stride, numWorkers, runLength):
+    '''
+    Source frame ranges [first, last) of runLength consecutive sampled frames
+    of range(start, stop, stride), dealt round-robin to the workers.
+    '''
+    sampled = range(start, stop, stride)
+    runs = [(sampled[k], min(stop, sampled[k] + runLength * stride)) for k in range(0, len(sampled), runLength)]
+    return [runs[w::numWorkers] for w in range(numWorkers)]
+
+
+def decode_worker(path, runs, stride, inp_dim, frameShape, frameBuf, imgBuf, freeSlots, readyQ):
+    '''
+    Decode the sampled frames of the source ranges runs into the shared ring
+    of this worker. The stream seeks once to the start of each run and decodes
+    it sequentially, frames between sampled ones are only grabbed and the runs
+    of the other workers are skipped, so each frame is decoded by one worker.
+    '''
+    try:
+        frames = np.frombuffer(frameBuf, dtype=np.uint8).reshape((-1,) + frameShape)
+        imgs = np.frombuffer(imgBuf, dtype=np.float32).reshape(-1, 3, inp_dim, inp_dim)
+        slots = frames.shape[0]
+        stream = cv2.VideoCapture(path)
+        k = 0
+        for first, last in runs:
+            if int(stream.get(cv2.CAP_PROP_POS_FRAMES)) != first:
+                stream.set(cv2.CAP_PROP_POS_FRAMES, first)
+            for i in range(first, last):
+                if (i - first) % stride:
+                    grabbed = stream.grab()
+                    if not grabbed:
+                        break
+                    continue
+                (grabbed, frame) = stream.read()
+                if not grabbed:
+                    break
+                freeSlots.acquire()
+                slot = k % slots
+                frames[slot] = frame
+                # same as prep_frame, written straight into shared memory
+                img = letterbox_image(frame, (inp_dim, inp_dim))
+                imgs[slot] = img[:, :, ::-1].transpose((2, 0, 1)).astype(np.float32) / 255.0
+                readyQ.put((i, slot, (frame.shape[1], frame.shape[0])))
+                k += 1
+            if not grabbed:
+                # end of the video
+                break
+        readyQ.put(None)
+    except Exception:
+        readyQ.put(traceback.format_exc())
+
+
+class FrameDecoderPool:
+    '''
+    Decodes and letterboxes video frames in numWorkers processes.
+    The frames of range(start, stop, stride) are split into contiguous runs of
+    `slots` sampled frames, dealt round-robin to the workers, so that each
+    worker seeks once per run and no frame is decoded twice. Frames come back
+    through per-worker shared-memory rings holding a run, so no frame is
+    pickled and every worker can decode a whole run ahead.
+    frames() yields them in the original order, in the prep_frame format.
+    '''
+    def __init__(self, path, numWorkers, inp_dim, slots=8, start=0, stop=None, stride=1):
+        stream = cv2.VideoCapture(path)
+        assert stream.isOpened(), 'Cannot capture source'
+        width = int(stream.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if stop is None:
+            stop = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        stream.release()
+
+        self.path = path
+        self.numWorkers = numWorkers
+        self.inp_dim = inp_dim
+        self.slots = slots
+        self.start = start
+        self.stop = stop
+        self.stride = stride
+        self.frameShape = (height, width, 3)
+        self.runs = frame_runs(start, stop, stride, numWorkers, slots)
+        self.workers = []
+        self.rings = []
+
+    def launch(self):
+        frameSize = int(np.prod(self.frameShape))
+        imgSize = 3 * self.inp_dim * self.inp_dim
+        for w in range(self.numWorkers):
+            frameBuf = mp.RawArray('B', self.slots * frameSize)
+            imgBuf = mp.RawArray('f', self.slots * imgSize)
+            freeSlots = mp.Semaphore(self.slots)
+            readyQ = mp.Queue()
+            p = mp.Process(target=decode_worker, args=(
+                self.path, self.runs[w], self.stride, self.inp_dim, self.frameShape,
+                frameBuf, imgBuf, freeSlots, readyQ))
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+            frames = np.frombuffer(frameBuf, dtype=np.uint8).reshape((self.slots,) + self.frameShape)
+            imgs = np.frombuffer(imgBuf, dtype=np.float32).reshape(self.slots, 3, self.inp_dim, self.inp_dim)
+            self.rings.append((frames, imgs, freeSlots, readyQ))
+        return self
+
+    def frames(self):
+        if not self.workers:
+            self.launch()
+        try:
+            for i in range(self.start, self.stop, self.stride):
+                # runs are dealt round-robin
+                run = (i - self.start) // self.stride // self.slots
+                frames, imgs, freeSlots, readyQ = self.rings[run % self.numWorkers]
+                msg = readyQ.get()
+                if msg is None:
+                    return
+                if not isinstance(msg, tuple):
+                    raise RuntimeError('Decode worker failed:\n' + msg)
+                index, slot, dim = msg
+                assert index == i
+                # copy out so the slot can be refilled while the frame moves down the pipeline
+                orig_img = frames[slot].copy()
+                img = torch.from_numpy(imgs[slot].copy()).unsqueeze(0)
+                freeSlots.release()
+                yield img, orig_img, dim
+        finally:
+            self.close()
+
+    def close(self):
+        for p in self.workers:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        self.workers = []
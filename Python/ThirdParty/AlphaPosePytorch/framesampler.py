@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+
+
+class MotionSampler:
+    '''
+    Adaptive frame selection for equirectangular videos.
+    Every candidate frame is compared with the last selected one by frame
+    differencing of small grayscale thumbnails, inside a window around the
+    subject box (wrapping in longitude). A frame is selected when the mean
+    absolute difference exceeds `threshold` (0-255 scale) or when `maxGap`
+    source frames went by since the last selected frame.
+    The consumer sets `box` (x1, y1, x2, y2 in frame pixels) to the last
+    subject box, before the first detection the whole frame is used.
+    VideoDetectionLoader.detect sets it, so the box lags the examined frame
+    by the selected frames queued for the detector (detectQueueSize plus a
+    batch). `margin` should cover the motion of the subject over that lag.
+    '''
+    def __init__(self, threshold=4.0, maxGap=30, thumbWidth=512, margin=0.5):
+        self.threshold = threshold
+        self.maxGap = maxGap
+        self.thumbWidth = thumbWidth
+        self.margin = margin
+        self.box = None
+        self.ref = None
+        self.last = None
+        self.examined = 0
+        self.selected = []
+
+    def thumbnail(self, frame):
+        scale = float(self.thumbWidth) / frame.shape[1]
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, (self.thumbWidth, max(1, int(round(frame.shape[0] * scale)))),
+                           interpolation=cv2.INTER_AREA)
+        # blur so that sensor noise and compression do not count as motion
+        return cv2.GaussianBlur(small, (5, 5), 0).astype(np.float32), scale
+
+    def window(self, shape, scale):
+        # rows and (wrapped) columns of the thumbnail around the subject box
+        height, width = shape
+        if self.box is None:
+            return slice(0, height), np.arange(width)
+        x1, y1, x2, y2 = [float(v) * scale for v in self.box[:4]]
+        mx = (x2 - x1) * self.margin
+        my = (y2 - y1) * self.margin
+        rows = slice(int(max(0, y1 - my)), int(min(height, np.ceil(y2 + my))))
+        cols = np.arange(int(np.floor(x1 - mx)), int(np.ceil(x2 + mx)) + 1) % width
+        return rows, cols
+
+    def motion(self, thumb, scale):
+        rows, cols = self.window(thumb.shape, scale)
+        current = thumb[rows][:, cols]
+        reference = self.ref[rows][:, cols]
+        if current.size == 0:
+            return float('inf')
+        return float(np.mean(np.abs(current - reference)))
+
+    def select(self, frames):
+        '''
+        Filters a stream of (index, frame, ...) tuples, yields the selected ones.
+        '''
+        for item in frames:
+            i, frame = item[0], item[1]
+            self.examined += 1
+            thumb, scale = self.thumbnail(frame)
+            if self.last is None or i - self.last >= self.maxGap or self.motion(thumb, scale) > self.threshold:
+                self.ref = thumb
+                self.last = i
+                self.selected.append(i)
+                yield item
+
+    def report(self):
+        return 'adaptive sampling: %d of %d candidate frames selected' % (len(self.selected), self.examined)
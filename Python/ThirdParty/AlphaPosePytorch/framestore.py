@@ -0,0 +1,195 @@
+import os
+import json
+
+import numpy as np
+
+# Chunked frame store shared by AlphaPose, HMR and DensePose.
+# Frames are kept as raw uint8 (n, H, W, 3) BGR .npy chunks next to an
+# index.json holding the per-frame metadata, so readers can memory-map
+# the chunks and index frames without any decoding.
+# Kept free of torch/cv2 and Python 2 compatible so that the hmr and
+# densepose scripts can import it too.
+
+_version = 1
+_indexName = 'index.json'
+
+
+def chunkName(chunk):
+    return 'chunk_%05d.npy' % chunk
+
+
+def toList(value):
+    # torch tensors and numpy arrays to plain lists for json
+    if value is None:
+        return None
+    if hasattr(value, 'cpu'):
+        value = value.cpu().numpy()
+    return np.asarray(value, dtype=np.float64).tolist()
+
+
+class FrameStoreWriter:
+    '''
+    Appends frames to a store directory. Frames are buffered in a
+    preallocated chunk and written with np.save once it is full, the
+    index is rewritten with every chunk so a partial store stays readable.
+    keep > 0 resumes an existing store after its first keep frames,
+    otherwise the directory is emptied.
+    '''
+    def __init__(self, path, chunkSize=64, info=None, keep=0):
+        self.path = path
+        self.chunkSize = chunkSize
+        # clip level metadata, e.g. source fps, first frame and stride
+        self.info = info or {}
+        self.buffer = None
+        self.filled = 0
+        self.chunk = 0
+        self.frames = []
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if keep > 0:
+            self.resume(keep)
+        # chunks from firstStale on are not referenced by the kept frames
+        firstStale = self.chunk + 1 if self.filled else self.chunk
+        for name in os.listdir(path):
+            if name == _indexName and keep > 0:
+                continue
+            if name == _indexName or (name.startswith('chunk_') and name.endswith('.npy')
+                                      and int(name[6:-4]) >= firstStale):
+                os.remove(os.path.join(path, name))
+        if keep > 0:
+            # so that the index only lists the kept frames until the next flush
+            self.writeIndex()
+
+    def resume(self, keep):
+        store = FrameStore(self.path)
+        self.chunkSize = store.chunkSize
+        self.info = store.info
+        self.frames = store.meta[:keep]
+        last = self.frames[-1]
+        # the frames of the last chunk go back to the buffer, it is rewritten when full
+        self.chunk = last['chunk']
+        self.filled = last['offset'] + 1
+        self.buffer = np.empty((self.chunkSize,) + store.frameShape, dtype=np.uint8)
+        self.buffer[:self.filled] = store.chunkArray(self.chunk)[:self.filled]
+        if self.filled == self.chunkSize:
+            self.chunk += 1
+            self.filled = 0
+
+    def append(self, img, name, camera_rot=None, boxes=None, keypoints=None, source_frame=None):
+        if self.buffer is None:
+            self.buffer = np.empty((self.chunkSize,) + img.shape, dtype=np.uint8)
+        assert img.shape == self.buffer.shape[1:], 'All frames of a store must have the same shape'
+        self.buffer[self.filled] = img
+        self.frames.append({
+            'name': name,
+            'chunk': self.chunk,
+            'offset': self.filled,
+            'camera_rot': toList(camera_rot),
+            'boxes': toList(boxes) if boxes is not None else [],
+            'keypoints': toList(keypoints) if keypoints is not None else [],
+        })
+        if source_frame is not None:
+            # position in the source video, frames may not be evenly spaced
+            self.frames[-1]['source_frame'] = int(source_frame)
+            if self.info.get('fps'):
+                self.frames[-1]['timestamp'] = source_frame / float(self.info['fps'])
+        self.filled += 1
+        if self.filled == self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.filled:
+            np.save(os.path.join(self.path, chunkName(self.chunk)), self.buffer[:self.filled])
+            self.chunk += 1
+            self.filled = 0
+        self.writeIndex()
+
+    def writeIndex(self):
+        index = {
+            'version': _version,
+            'frameShape': list(self.buffer.shape[1:]) if self.buffer is not None else None,
+            'chunkSize': self.chunkSize,
+            'info': self.info,
+            'frames': self.frames,
+        }
+        tmpPath = os.path.join(self.path, _indexName + '.tmp')
+        with open(tmpPath, 'w') as f:
+            json.dump(index, f)
+        if os.path.exists(os.path.join(self.path, _indexName)):
+            os.remove(os.path.join(self.path, _indexName))
+        os.rename(tmpPath, os.path.join(self.path, _indexName))
+
+    def close(self):
+        self.flush()
+        self.buffer = None
+
+
+class FrameStore:
+    '''
+    Read side of the store. Chunks are opened with mmap_mode='r', so the
+    frames returned by frame() and chunks() are read-only views into the
+    files, not copies.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _indexName)) as f:
+            index = json.load(f)
+        assert index['version'] == _version, 'Unsupported frame store version %s' % index['version']
+        self.frameShape = tuple(index['frameShape']) if index['frameShape'] else None
+        self.chunkSize = index['chunkSize']
+        self.info = index.get('info', {})
+        self.meta = index['frames']
+        self.maps = {}
+        self.names = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, _indexName))
+
+    def __len__(self):
+        return len(self.meta)
+
+    def chunkArray(self, chunk):
+        if chunk not in self.maps:
+            self.maps[chunk] = np.load(os.path.join(self.path, chunkName(chunk)), mmap_mode='r')
+        return self.maps[chunk]
+
+    def frame(self, i):
+        m = self.meta[i]
+        return self.chunkArray(m['chunk'])[m['offset']]
+
+    def chunks(self):
+        # yields (first frame index, (n, H, W, 3) view) for each chunk
+        start = 0
+        chunk = 0
+        while start < len(self.meta):
+            frames = self.chunkArray(chunk)
+            yield start, frames
+            start += len(frames)
+            chunk += 1
+
+    def frames(self):
+        for start, frames in self.chunks():
+            for k in range(len(frames)):
+                yield start + k, frames[k]
+
+    def cameraRot(self, i):
+        return self.meta[i]['camera_rot']
+
+    def sourceFrame(self, i):
+        # index of the frame in the source video
+        if 'source_frame' in self.meta[i]:
+            return self.meta[i]['source_frame']
+        return self.info.get('start_frame', 0) + i * self.info.get('stride', 1)
+
+    def timestamp(self, i):
+        # time of the frame in the source video, in seconds
+        if 'timestamp' in self.meta[i]:
+            return self.meta[i]['timestamp']
+        return self.sourceFrame(i) / float(self.info.get('fps', 1.0))
+
+    def index(self, name):
+        # frame index from its image name, e.g. '12.png'
+        if self.names is None:
+            self.names = dict((m['name'], i) for i, m in enumerate(self.meta))
+        return self.names[name]
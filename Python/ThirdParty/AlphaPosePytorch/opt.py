@@ -123,6 +123,8 @@ parser.add_argument('--vis', default=False, action='store_true',
                     help='visualize image')
 parser.add_argument('--format', default='coco', type=str,
                     help='save in the format of cmu or coco')
+parser.add_argument('--kp_refine', default='sign', type=str, choices=['sign', 'taylor', 'none'],
+                    help='sub-pixel keypoint refinement: sign | taylor | none (integer peak)')
 
 "----------------------------- Video options -----------------------------"
 parser.add_argument('--video', dest='video',
@@ -133,6 +135,36 @@ parser.add_argument('--save_video', dest='save_video',
                     help='whether to save rendered video', default=False, action='store_true')
 parser.add_argument('--vis_fast', dest='vis_fast',
                     help='use fast rendering', action='store_true', default=False)
+parser.add_argument('--frame_stride', dest='frame_stride', type=int, default=1,
+                    help='only process every n-th frame of the video')
+parser.add_argument('--time_range', dest='time_range', type=str, default='',
+                    help='part of the video to process, "start:end" in seconds (either side may be empty)')
+parser.add_argument('--adaptive_stride', dest='adaptive_stride', type=int, default=0,
+                    help='select frames by motion, every frame_stride-th frame is a candidate and at most this many frames are skipped (0 = fixed stride)')
+parser.add_argument('--motion_thresh', dest='motion_thresh', type=float, default=4.0,
+                    help='mean absolute difference (0-255) around the subject that selects a frame with adaptive sampling')
+parser.add_argument('--det_interval', dest='det_interval', type=int, default=1,
+                    help='run the person detector every n-th frame and track the subject in between (1 = detect every frame)')
+parser.add_argument('--track_thresh', dest='track_thresh', type=float, default=0.5,
+                    help='tracking confidence under which the detector is run again before the next scheduled detection')
+parser.add_argument('--det_tiles', dest='det_tiles', type=str, default='',
+                    help='detect on perspective tiles of inp_dim reprojected from the 360 frame: cube | number of overlapping views around the horizon (empty = letterboxed frame)')
+parser.add_argument('--tile_fov', dest='tile_fov', type=float, default=0,
+                    help='field of view of the detection tiles in degrees (0 = 100 for cube, 1.5 times the view spacing but at least 90 otherwise)')
+parser.add_argument('--decode_workers', dest='decode_workers', type=int, default=0,
+                    help='number of processes decoding and letterboxing frames (0 = decode in a thread)')
+parser.add_argument('--rect_step', dest='rect_step', type=float, default=0.25,
+                    help='angular step (degrees) used to quantize and cache rectification views')
+parser.add_argument('--rect_cache', dest='rect_cache', type=int, default=64,
+                    help='number of rectification maps kept in the LRU cache')
+parser.add_argument('--rect_interp', dest='rect_interp', type=str, default='nearest',
+                    help='rectification sampling: nearest | bilinear | bicubic')
+parser.add_argument('--framestore', dest='framestore', default=False, action='store_true',
+                    help='save the rectified frames and their metadata to a memory-mappable store in outdir/framestore')
+parser.add_argument('--framestore_chunk', dest='framestore_chunk', type=int, default=64,
+                    help='number of frames per frame store chunk')
+parser.add_argument('--restart', dest='restart', default=False, action='store_true',
+                    help='ignore the checkpoint manifest of outdir and process the whole video again')
 opt = parser.parse_args()
 
 opt.num_classes = 80
@@ -16,6 +16,7 @@ gamma = 22.48
 scoreThreds = 0.3
 matchThreds = 5
 alpha = 0.1
+pair_margin = 8
 #pool = ThreadPool(4)
 
 
@@ -46,38 +47,10 @@ def pose_nms(bboxes, bbox_scores, pose_preds, pose_scores, rot):
     heights = ymax - ymin
     ref_dists = alpha * np.maximum(widths, heights)
 
-    nsamples = bboxes.shape[0]
     human_scores = pose_scores.mean(dim=1)
 
-    human_ids = np.arange(nsamples)
     # Do pPose-NMS
-    pick = []
-    merge_ids = []
-    while(human_scores.shape[0] != 0):
-        # Pick the one with highest score
-        pick_id = torch.argmax(human_scores)
-        pick.append(human_ids[pick_id])
-        # num_visPart = torch.sum(pose_scores[pick_id] > 0.2)
-
-        # Get numbers of match keypoints by calling PCK_match
-        ref_dist = ref_dists[human_ids[pick_id]]
-        simi = get_parametric_distance(pick_id, pose_preds, pose_scores, ref_dist)
-        num_match_keypoints = PCK_match(pose_preds[pick_id], pose_preds, ref_dist)
-
-        # Delete humans who have more than matchThreds keypoints overlap and high similarity
-        delete_ids = torch.from_numpy(np.arange(human_scores.shape[0]))[(simi > gamma) | (num_match_keypoints >= matchThreds)]
-
-        if delete_ids.shape[0] == 0:
-            delete_ids = pick_id
-        #else:
-        #    delete_ids = torch.from_numpy(delete_ids)
-
-        merge_ids.append(human_ids[delete_ids])
-        pose_preds = np.delete(pose_preds, delete_ids, axis=0)
-        pose_scores = np.delete(pose_scores, delete_ids, axis=0)
-        human_ids = np.delete(human_ids, delete_ids)
-        human_scores = np.delete(human_scores, delete_ids, axis=0)
-        bbox_scores = np.delete(bbox_scores, delete_ids, axis=0)
+    pick, merge_ids = parametric_pick(pose_preds, pose_scores, human_scores, ref_dists)
 
     assert len(merge_ids) == len(pick)
     preds_pick = ori_pose_preds[pick]
@@ -120,6 +93,78 @@ def pose_nms(bboxes, bbox_scores, pose_preds, pose_scores, rot):
     return final_result
 
 
+def parametric_pick(pose_preds, pose_scores, human_scores, ref_dists):
+    '''
+    Greedy pick on precomputed pairwise matrices
+    INPUT:
+        pose_preds:     pose locations          -- [n, 17, 2]
+        pose_scores:    pose scores             -- [n, 17, 1]
+        human_scores:   mean pose scores        -- [n, 1]
+        ref_dists:      reference scales        -- [n]
+    OUTPUT:
+        pick:           picked human ids        -- list
+        merge_ids:      ids merged in each pick -- list of arrays
+    '''
+    nsamples = pose_preds.shape[0]
+    suppress = get_suppression_matrix(pose_preds, pose_scores, ref_dists)
+
+    human_scores = human_scores.numpy().reshape(-1).astype(np.float64)
+    remaining = np.ones(nsamples, dtype=bool)
+    pick = []
+    merge_ids = []
+    while remaining.any():
+        # Pick the one with highest score
+        pick_id = int(np.argmax(np.where(remaining, human_scores, -np.inf)))
+        pick.append(pick_id)
+
+        # Delete humans who have more than matchThreds keypoints overlap and high similarity
+        delete_mask = remaining & suppress[pick_id]
+        if not delete_mask.any():
+            delete_mask[pick_id] = True
+
+        merge_ids.append(np.where(delete_mask)[0])
+        remaining &= ~delete_mask
+
+    return pick, merge_ids
+
+
+def parametric_pick_loop(pose_preds, pose_scores, human_scores, ref_dists):
+    '''
+    Reference implementation of parametric_pick, one pick at a time
+    '''
+    pose_preds = pose_preds.clone()
+    pose_scores = pose_scores.clone()
+    human_ids = np.arange(pose_preds.shape[0])
+    pick = []
+    merge_ids = []
+    while(human_scores.shape[0] != 0):
+        # Pick the one with highest score
+        pick_id = torch.argmax(human_scores)
+        pick.append(human_ids[pick_id])
+        # num_visPart = torch.sum(pose_scores[pick_id] > 0.2)
+
+        # Get numbers of match keypoints by calling PCK_match
+        ref_dist = ref_dists[human_ids[pick_id]]
+        simi = get_parametric_distance(pick_id, pose_preds, pose_scores, ref_dist)
+        num_match_keypoints = PCK_match(pose_preds[pick_id], pose_preds, ref_dist)
+
+        # Delete humans who have more than matchThreds keypoints overlap and high similarity
+        delete_ids = torch.from_numpy(np.arange(human_scores.shape[0]))[(simi > gamma) | (num_match_keypoints >= matchThreds)]
+
+        if delete_ids.shape[0] == 0:
+            delete_ids = pick_id
+        #else:
+        #    delete_ids = torch.from_numpy(delete_ids)
+
+        merge_ids.append(human_ids[delete_ids])
+        pose_preds = np.delete(pose_preds, delete_ids, axis=0)
+        pose_scores = np.delete(pose_scores, delete_ids, axis=0)
+        human_ids = np.delete(human_ids, delete_ids)
+        human_scores = np.delete(human_scores, delete_ids, axis=0)
+
+    return pick, merge_ids
+
+
 def filter_result(args):
     score_pick, merge_id, pred_pick, pick, bbox_score_pick = args
     global ori_pose_preds, ori_pose_scores, ref_dists
@@ -279,6 +324,73 @@ def PCK_match(pick_pred, all_preds, ref_dist):
     return num_match_keypoints
 
 
+def get_suppression_matrix(all_preds, keypoint_scores, ref_dists):
+    '''
+    Pairwise deletion test of pPose-NMS, row i holds the humans deleted when i is picked
+    INPUT:
+        all_preds:          pose locations      -- [n, 17, 2]
+        keypoint_scores:    pose scores         -- [n, 17, 1]
+        ref_dists:          reference scales    -- [n]
+    OUTPUT:
+        suppress:           deletion mask       -- [n, n] bool
+    '''
+    nsamples = all_preds.shape[0]
+    suppress = np.zeros((nsamples, nsamples), dtype=bool)
+
+    # Keypoints of two poses are at least as far apart as their extents.
+    # Beyond pair_margin neither PCK_match (ref_dist <= 7) nor the
+    # parametric distance (needs keypoints within ~1px) can reach its threshold.
+    mins = all_preds.min(dim=1)[0]
+    maxs = all_preds.max(dim=1)[0]
+    gaps = torch.clamp(torch.max(mins[:, np.newaxis] - maxs[np.newaxis, :],
+                                 mins[np.newaxis, :] - maxs[:, np.newaxis]), min=0)
+    candidates = torch.sqrt(torch.sum(torch.pow(gaps, 2), dim=2)) <= pair_margin
+    ii, jj = torch.nonzero(candidates, as_tuple=True)
+
+    simi = get_parametric_distance_pairs(ii, jj, all_preds, keypoint_scores)
+    num_match_keypoints = PCK_match_pairs(ii, jj, all_preds, ref_dists)
+    suppress[ii.numpy(), jj.numpy()] = ((simi > gamma) | (num_match_keypoints >= matchThreds)).numpy()
+    return suppress
+
+
+def get_parametric_distance_pairs(ii, jj, all_preds, keypoint_scores):
+    '''
+    get_parametric_distance evaluated for the pose pairs (ii[k], jj[k])
+    '''
+    dist = torch.sqrt(torch.sum(
+        torch.pow(all_preds[ii] - all_preds[jj], 2),
+        dim=2
+    ))
+    mask = (dist <= 1)
+
+    # Define a keypoints distance
+    keypoint_scores = keypoint_scores.reshape(all_preds.shape[0], -1)
+    score_dists = torch.zeros(dist.shape)
+    score_dists[mask] = torch.tanh(keypoint_scores[ii][mask] / delta1) * torch.tanh(keypoint_scores[jj][mask] / delta1)
+
+    point_dist = torch.exp((-1) * dist / delta2)
+    final_dist = torch.sum(score_dists, dim=1) + mu * torch.sum(point_dist, dim=1)
+
+    return final_dist
+
+
+def PCK_match_pairs(ii, jj, all_preds, ref_dists):
+    '''
+    PCK_match evaluated for the pose pairs (ii[k], jj[k]), with the scale of ii[k]
+    '''
+    dist = torch.sqrt(torch.sum(
+        torch.pow(all_preds[ii] - all_preds[jj], 2),
+        dim=2
+    ))
+    ref_dists = torch.clamp(torch.as_tensor(ref_dists, dtype=dist.dtype), max=7)
+    num_match_keypoints = torch.sum(
+        dist / ref_dists[ii][:, np.newaxis] <= 1,
+        dim=1
+    )
+
+    return num_match_keypoints
+
+
 def write_json(all_results, outputpath, for_eval=False):
     '''
     all_result: result dict of predictions
@@ -339,3 +451,52 @@ def write_json(all_results, outputpath, for_eval=False):
         with open(os.path.join(outputpath,'alphapose-results.json'), 'w') as json_file:
             json_file.write(json.dumps(json_results))
 
+
+
+def synthetic_poses(npeople, dups=4, spread=3840, seed=0):
+    '''
+    Random crowd with several jittered detections per person
+    '''
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, spread, (npeople, 1, 2))
+    sizes = rng.uniform(50, 300, (npeople, 1, 1))
+    base = centers + sizes * rng.uniform(-0.5, 0.5, (npeople, 17, 2))
+    ndets = rng.randint(1, dups + 1, npeople)
+    owner = np.repeat(np.arange(npeople), ndets)
+    preds = base[owner] + rng.normal(0, 3, (len(owner), 17, 2))
+    scores = rng.uniform(0, 1, (len(owner), 17, 1))
+    scores[scores < 0.05] = 0
+    mins, maxs = preds.min(axis=1), preds.max(axis=1)
+    bboxes = np.hstack((mins, maxs))
+    bbox_scores = rng.uniform(0.2, 1, (len(owner), 1))
+    return (torch.from_numpy(bboxes).float(), torch.from_numpy(bbox_scores).float(),
+            torch.from_numpy(preds).float(), torch.from_numpy(scores).float())
+
+
+def benchmark_pose_nms(sizes=(1, 2, 5, 10, 20, 50, 100, 200, 500)):
+    '''
+    Check parametric_pick against the loop reference and time both
+    '''
+    for npeople in sizes:
+        bboxes, bbox_scores, preds, scores = synthetic_poses(npeople, seed=npeople)
+        scores[scores == 0] = 1e-5
+        widths = bboxes[:, 2] - bboxes[:, 0]
+        heights = bboxes[:, 3] - bboxes[:, 1]
+        ref_dists = alpha * np.maximum(widths, heights)
+        human_scores = scores.mean(dim=1)
+
+        start = time.time()
+        pick, merge_ids = parametric_pick(preds, scores, human_scores, ref_dists)
+        fast_time = time.time() - start
+        start = time.time()
+        ref_pick, ref_merge_ids = parametric_pick_loop(preds, scores, human_scores, ref_dists)
+        loop_time = time.time() - start
+
+        same = [int(i) for i in pick] == [int(i) for i in ref_pick] and all(
+            np.array_equal(np.atleast_1d(a), np.atleast_1d(b)) for a, b in zip(merge_ids, ref_merge_ids))
+        print('%3d people | %4d poses | loop %8.2f ms | matrix %7.2f ms | %s' % (
+            npeople, preds.shape[0], 1000 * loop_time, 1000 * fast_time, 'same' if same else 'DIFFERENT'))
+
+
+if __name__ == "__main__":
+    benchmark_pose_nms()
@@ -0,0 +1,192 @@
+import sys
+import time
+from threading import Thread, Event
+# import the Queue class from Python 3
+if sys.version_info >= (3, 0):
+    from queue import Queue
+# otherwise, import the Queue class for Python 2.7
+else:
+    from Queue import Queue
+
+# Marks the end of the stream, every stage forwards it once and exits
+END = object()
+
+
+class Stage:
+    '''
+    One pipeline stage: a thread taking items from a bounded blocking queue,
+    applying fn and putting the results into the next stage's queue.
+    fn gets one item (or a list of up to batchSize items) and returns one
+    item (or a list for batches); returning None drops the item.
+    '''
+    def __init__(self, name, fn, queueSize=64, batchSize=1):
+        self.name = name
+        self.fn = fn
+        self.batchSize = batchSize
+        self.Q = Queue(maxsize=queueSize)
+        self.output = None
+        self.pipeline = None
+        self.error = None
+        self.count = 0
+        self.busy = 0.0
+        self.waited = 0.0
+        self.blocked = 0.0
+        self.startTime = None
+        self.endTime = None
+
+    def put(self, item):
+        # blocks while the queue is full, which throttles the producer
+        self.Q.put(item)
+
+    def emit(self, item):
+        if self.output is not None:
+            start = time.time()
+            self.output.put(item)
+            self.blocked += time.time() - start
+
+    def take(self):
+        # returns up to batchSize items and whether END was reached
+        items = []
+        while len(items) < self.batchSize:
+            start = time.time()
+            item = self.Q.get()
+            self.waited += time.time() - start
+            if item is END:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def process(self, items):
+        start = time.time()
+        if self.batchSize > 1:
+            results = self.fn(items)
+        else:
+            results = [self.fn(items[0])]
+        self.busy += time.time() - start
+        self.count += len(items)
+        for result in results:
+            if result is not None:
+                self.emit(result)
+
+    def run(self):
+        self.startTime = time.time()
+        done = False
+        try:
+            while not done:
+                items, done = self.take()
+                if items:
+                    self.process(items)
+        except Exception:
+            self.error = sys.exc_info()
+            if self.pipeline is not None:
+                self.pipeline.stopped.set()
+            # keep draining so that upstream stages never block on a full queue
+            while not done:
+                done = self.Q.get() is END
+        finally:
+            self.endTime = time.time()
+            self.emit(END)
+
+    def stats(self):
+        elapsed = (self.endTime or time.time()) - (self.startTime or time.time())
+        return {
+            'name': self.name,
+            'count': self.count,
+            'throughput': self.count / elapsed if elapsed > 0 else 0.0,
+            'latency': self.busy / self.count if self.count else 0.0,
+            'wait': self.waited,
+            'blocked': self.blocked,
+            'queued': self.Q.qsize(),
+        }
+
+
+class Source(Stage):
+    '''
+    First stage of a pipeline, emits the items of a generator.
+    '''
+    def __init__(self, name, generator):
+        Stage.__init__(self, name, None, queueSize=1)
+        self.generator = generator
+
+    def run(self):
+        self.startTime = time.time()
+        try:
+            start = time.time()
+            for item in self.generator:
+                self.busy += time.time() - start
+                self.count += 1
+                if self.pipeline is not None and self.pipeline.stopped.is_set():
+                    break
+                self.emit(item)
+                start = time.time()
+        except Exception:
+            self.error = sys.exc_info()
+            if self.pipeline is not None:
+                self.pipeline.stopped.set()
+        finally:
+            self.endTime = time.time()
+            self.emit(END)
+
+
+class Pipeline:
+    '''
+    Chain of stages, each running in its own thread and connected by
+    bounded blocking queues. END is sent through the chain on shutdown, so
+    join() returns once every item has been processed.
+    '''
+    def __init__(self):
+        self.stages = []
+        self.threads = []
+        self.stopped = Event()
+
+    def source(self, name, generator):
+        return self.append(Source(name, generator))
+
+    def add(self, name, fn, queueSize=64, batchSize=1):
+        return self.append(Stage(name, fn, queueSize, batchSize))
+
+    def append(self, stage):
+        if self.stages:
+            self.stages[-1].output = stage.Q
+        stage.pipeline = self
+        self.stages.append(stage)
+        return stage
+
+    def output(self, queue):
+        # send the results of the last stage to an external queue
+        self.stages[-1].output = queue
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def close(self):
+        # signal the end of the input when the first stage is not a Source
+        self.stages[0].put(END)
+
+    def start(self):
+        for stage in self.stages:
+            t = Thread(target=stage.run, args=(), name=stage.name)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error[1]
+
+    def running(self):
+        return any(t.is_alive() for t in self.threads)
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def report(self):
+        lines = []
+        for s in self.stats():
+            lines.append('%-10s | %6d items | %7.2f it/s | %8.4f s/it | wait %7.2f s | blocked %7.2f s' % (
+                s['name'], s['count'], s['throughput'], s['latency'], s['wait'], s['blocked']))
+        return '\n'.join(lines)
@@ -0,0 +1,130 @@
+import numpy as np
+from rectifyimage import createBaseGrid, createViewRotation, createRemapMaps, remapEquirect, equirectCoords, rotate
+from tracker import wrapped_dx, wrapped_align
+
+
+def tileViews(layout):
+    '''
+    View directions (rotTheta, rotPhi) of the tiles and their default field
+    of view in degrees. layout is 'cube' for the 6 faces of a cube map, with
+    a little overlap so that people on an edge are whole in one face, or the
+    number of overlapping views around the horizon.
+    '''
+    if layout == 'cube':
+        views = [(k * np.pi / 2, 0.0) for k in range(4)] + [(0.0, np.pi / 2), (0.0, -np.pi / 2)]
+        return views, 100.0
+    n = int(layout)
+    return [(2 * np.pi * k / n, 0.0) for k in range(n)], max(90.0, 1.5 * 360.0 / n)
+
+
+class TileProjector:
+    '''
+    Reprojects equirectangular frames into square perspective tiles of
+    size dim, so that the detector sees people at native resolution and
+    undistorted, and maps the boxes found in the tiles back to the frame.
+    The remap tables of all the tiles are built once per frame size and
+    the tiles are stacked in a single cv2.remap call.
+    '''
+    def __init__(self, layout, dim, fov=0, interpolation='bilinear'):
+        self.views, defaultFov = tileViews(layout)
+        self.fov = np.radians(fov if fov > 0 else defaultFov)
+        self.dim = dim
+        self.d = dim / 2.0 / np.tan(self.fov / 2)
+        self.rotations = [createViewRotation(rotTheta, rotPhi) for rotTheta, rotPhi in self.views]
+        self.interpolation = interpolation
+        self.frameSize = None
+        self.maps = None
+
+    def __len__(self):
+        return len(self.views)
+
+    def prepare(self, inputWidth, inputHeight):
+        if self.frameSize == (inputWidth, inputHeight):
+            return
+        grid = createBaseGrid(self.dim, self.d)
+        grid3D = np.concatenate([rotate(grid, R) for R in self.rotations])
+        self.maps = createRemapMaps(grid3D, (len(self) * self.dim, self.dim),
+                                    inputWidth, inputHeight, self.interpolation)
+        self.frameSize = (inputWidth, inputHeight)
+
+    def tiles(self, frame):
+        # all the tiles of a frame -- [n, dim, dim, 3]
+        inputHeight, inputWidth = frame.shape[:2]
+        self.prepare(inputWidth, inputHeight)
+        mapX, mapY, padRows = self.maps
+        tiles = remapEquirect(frame, mapX, mapY, padRows, self.interpolation)
+        return tiles.reshape(len(self), self.dim, self.dim, 3)
+
+    def rays(self, tile, u, v):
+        # world direction of tile pixels (u right, v down), same convention as createBaseGrid
+        points = np.stack((self.dim / 2.0 - u, self.dim / 2.0 - v, np.full(np.shape(u), self.d)), -1)
+        return rotate(points.reshape(-1, 3), self.rotations[tile])
+
+    def toEquirect(self, tile, boxes, inputWidth, inputHeight, samples=9):
+        '''
+        Boxes (n, 4) of a tile to boxes of the frame, bounding their edges
+        projected in the frame. The box center is wrapped into the frame,
+        so x1 may be negative or x2 past the width for a box on the seam.
+        A box containing a pole spans the whole width.
+        '''
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        n = len(boxes)
+        t = np.linspace(0, 1, samples)
+        x1, y1, x2, y2 = [boxes[:, k:k + 1] for k in range(4)]
+        edgeX = x1 + (x2 - x1) * t
+        edgeY = y1 + (y2 - y1) * t
+        u = np.hstack((edgeX, np.repeat(x2, samples, 1), edgeX, np.repeat(x1, samples, 1)))
+        v = np.hstack((np.repeat(y1, samples, 1), edgeY, np.repeat(y2, samples, 1), edgeY))
+        X, Y = equirectCoords(self.rays(tile, u, v), inputWidth, inputHeight)
+        X, Y = X.reshape(n, -1), Y.reshape(n, -1)
+        # unwrap the longitudes around the one of the box center
+        centerX, _ = equirectCoords(self.rays(tile, (x1 + x2) / 2.0, (y1 + y2) / 2.0), inputWidth, inputHeight)
+        X = centerX[:, None] + wrapped_dx(X, centerX[:, None], inputWidth)
+        result = np.column_stack((X.min(1), Y.min(1), X.max(1), Y.max(1)))
+        for pole, y in ((np.array([0, 1, 0]), 0), (np.array([0, -1, 0]), inputHeight - 1)):
+            px, py, pz = np.dot(self.rotations[tile].T, pole)
+            if pz <= 0:
+                continue
+            pu = self.dim / 2.0 - px * self.d / pz
+            pv = self.dim / 2.0 - py * self.d / pz
+            inside = (boxes[:, 0] <= pu) & (pu <= boxes[:, 2]) & (boxes[:, 1] <= pv) & (pv <= boxes[:, 3])
+            result[inside, 0] = 0
+            result[inside, 2] = inputWidth - 1
+            result[inside, 1 if y == 0 else 3] = y
+        shift = (result[:, 0] + result[:, 2]) / 2.0
+        shift = shift % inputWidth - shift
+        result[:, [0, 2]] += shift[:, None]
+        return result
+
+
+def mergeTileBoxes(boxes, scores, inputWidth, iouThresh=0.5, containThresh=0.7):
+    '''
+    Merges the frame boxes found in several tiles. In decreasing score
+    order, a box overlapping a kept box (IoU over iouThresh, or intersection
+    over containThresh of the smaller one, for a person cut by a tile border)
+    is merged into it, the kept box growing to their union.
+    Returns the kept boxes (n, 4) and scores (n,).
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    kept = []
+    keptScores = []
+    for i in np.argsort(-scores, kind='mergesort'):
+        for k, other in enumerate(kept):
+            box = wrapped_align(other, boxes[i], inputWidth)[0]
+            iw = min(other[2], box[2]) - max(other[0], box[0])
+            ih = min(other[3], box[3]) - max(other[1], box[1])
+            if iw <= 0 or ih <= 0:
+                continue
+            inter = iw * ih
+            areas = ((other[2] - other[0]) * (other[3] - other[1]), (box[2] - box[0]) * (box[3] - box[1]))
+            if inter / (sum(areas) - inter) > iouThresh or inter / max(min(areas), 1e-6) > containThresh:
+                kept[k] = np.concatenate((np.minimum(other[:2], box[:2]), np.maximum(other[2:], box[2:])))
+                break
+        else:
+            kept.append(boxes[i].copy())
+            keptScores.append(scores[i])
+    kept = np.array(kept).reshape(-1, 4)
+    shift = (kept[:, 0] + kept[:, 2]) / 2.0
+    kept[:, [0, 2]] += (shift % inputWidth - shift)[:, None]
+    return kept, np.array(keptScores)
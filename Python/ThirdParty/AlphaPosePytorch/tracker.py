@@ -0,0 +1,205 @@
+import cv2
+import numpy as np
+
+
+def wrapped_dx(x, ref, width):
+    # signed horizontal offset from ref to x on the 360 degree frame
+    return (x - ref + width / 2.0) % width - width / 2.0
+
+
+def wrapped_align(box, boxes, width):
+    # boxes (n, 4) moved by a multiple of the frame width to their copy closest to box
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4).copy()
+    cx = (box[0] + box[2]) / 2.0
+    shift = wrapped_dx((boxes[:, 0] + boxes[:, 2]) / 2.0, cx, width) + cx - (boxes[:, 0] + boxes[:, 2]) / 2.0
+    boxes[:, [0, 2]] += shift[:, None]
+    return boxes
+
+
+def wrapped_iou(box, boxes, width):
+    '''
+    IoU of box with each of boxes (n, 4), every box being moved by a
+    multiple of the frame width to its copy closest to box.
+    '''
+    boxes = wrapped_align(box, boxes, width)
+    iw = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    ih = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    inter = iw * ih
+    union = (box[2] - box[0]) * (box[3] - box[1]) + (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+class SubjectTracker:
+    '''
+    Follows one subject between detector calls on equirectangular frames.
+    The detector is asked for every `interval` frames, or as soon as the
+    tracking confidence falls under `threshold`. In between the box is
+    moved with pyramidal Lucas-Kanade flow of corners inside it, computed
+    on a downscaled window that wraps in longitude.
+    On detection frames the subject is the detection overlapping the
+    tracked box the most, so it keeps its identity instead of being
+    whichever box comes first.
+    '''
+    def __init__(self, interval=5, threshold=0.5, windowSize=256, margin=0.5):
+        self.interval = interval
+        self.threshold = threshold
+        self.windowSize = windowSize
+        self.margin = margin
+        self.box = None
+        self.score = 0.0
+        self.confidence = 0.0
+        self.sinceDetection = 0
+        self.prev = None
+        self.detections = 0
+        self.tracked = 0
+
+    def lost(self):
+        return self.box is None or self.confidence < self.threshold
+
+    def schedule(self, n):
+        # which of the next n frames should run the detector, assuming the
+        # planned detections succeed (the caller checks lost() before
+        # tracking a frame, a detection may have found nobody)
+        plan = []
+        since, lost = self.sinceDetection, self.lost()
+        for k in range(n):
+            if lost or since >= self.interval - 1:
+                plan.append(True)
+                since, lost = 0, False
+            else:
+                plan.append(False)
+                since += 1
+        return plan
+
+    def window(self, frame):
+        # downscaled gray window around the box, columns wrap around the frame
+        height, width = frame.shape[:2]
+        x1, y1, x2, y2 = self.box
+        mx = (x2 - x1) * self.margin
+        my = (y2 - y1) * self.margin
+        x0 = int(np.floor(x1 - mx))
+        y0 = int(max(0, np.floor(y1 - my)))
+        ye = int(max(y0 + 1, min(height, np.ceil(y2 + my))))
+        cols = np.arange(x0, int(np.ceil(x2 + mx))) % width
+        region = (y0, ye, cols)
+        gray = self.sample(frame, region)
+        scale = min(1.0, float(self.windowSize) / max(gray.shape[:2]))
+        if scale < 1.0:
+            gray = cv2.resize(gray, (max(1, int(gray.shape[1] * scale)), max(1, int(gray.shape[0] * scale))),
+                              interpolation=cv2.INTER_AREA)
+        return gray, (x0, y0), scale, region
+
+    def sample(self, frame, region):
+        y0, ye, cols = region
+        return cv2.cvtColor(np.ascontiguousarray(frame[y0:ye][:, cols]), cv2.COLOR_BGR2GRAY)
+
+    def seed(self, frame):
+        # corners inside the box, for the next call to track
+        gray, origin, scale, region = self.window(frame)
+        mask = np.zeros_like(gray)
+        x1, y1, x2, y2 = [(v - o) * scale for v, o in zip(self.box, origin + origin)]
+        mask[int(max(0, y1)):int(max(0, y2)), int(max(0, x1)):int(max(0, x2))] = 255
+        points = cv2.goodFeaturesToTrack(gray, 100, 0.01, 3, mask=mask)
+        self.prev = (gray, scale, region, points)
+
+    def update(self, frame, boxes, scores):
+        '''
+        Detector results for frame. Returns them reordered with the
+        subject first, or (None, None) when nothing was detected.
+        '''
+        self.detections += 1
+        self.sinceDetection = 0
+        if boxes is None or len(boxes) == 0:
+            self.box = None
+            self.prev = None
+            self.confidence = 0.0
+            return None, None
+        width = frame.shape[1]
+        boxesArray = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        scoresArray = np.asarray(scores, dtype=np.float64).reshape(-1)
+        subject = 0
+        if self.box is not None:
+            ious = wrapped_iou(self.box, boxesArray, width)
+            if ious.max() > 0.1:
+                subject = int(np.argmax(ious))
+            else:
+                # closest detection in longitude, relative to the box size
+                cx = (self.box[0] + self.box[2]) / 2.0
+                dist = np.abs(wrapped_dx((boxesArray[:, 0] + boxesArray[:, 2]) / 2.0, cx, width))
+                subject = int(np.argmin(dist / max(self.box[2] - self.box[0], 1.0)))
+        self.box = boxesArray[subject].copy()
+        self.score = float(scoresArray[subject])
+        self.confidence = 1.0
+        self.seed(frame)
+        order = [subject] + [k for k in range(len(boxesArray)) if k != subject]
+        return boxes[order], scores[order]
+
+    def track(self, frame):
+        '''
+        Moves the box to frame. Returns the box (x1, y1, x2, y2, the
+        center being wrapped into the frame) and its confidence, the
+        detection score times the fraction of corners tracked reliably.
+        (None, 0.0) when there is no box to follow.
+        '''
+        if self.box is None or self.prev is None:
+            self.confidence = 0.0
+            return None, self.confidence
+        self.sinceDetection += 1
+        self.tracked += 1
+        prevGray, scale, region, points = self.prev
+        if points is None or len(points) < 4:
+            self.confidence = 0.0
+            return self.box, self.confidence
+        width = frame.shape[1]
+        # same window as the previous frame
+        gray = self.sample(frame, region)
+        if gray.shape != prevGray.shape:
+            gray = cv2.resize(gray, (prevGray.shape[1], prevGray.shape[0]), interpolation=cv2.INTER_AREA)
+        nextPoints, status, _ = cv2.calcOpticalFlowPyrLK(prevGray, gray, points, None)
+        backPoints, backStatus, _ = cv2.calcOpticalFlowPyrLK(gray, prevGray, nextPoints, None)
+        # forward-backward check
+        error = np.linalg.norm((backPoints - points).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (backStatus.ravel() == 1) & (error < 1.0)
+        self.confidence = self.score * good.sum() / float(len(points))
+        if good.sum() < 4:
+            self.confidence = 0.0
+            return self.box, self.confidence
+        before = points.reshape(-1, 2)[good]
+        after = nextPoints.reshape(-1, 2)[good]
+        shift = np.median(after - before, axis=0) / scale
+        # scale change from the spread of the points around their median
+        spreadBefore = np.median(np.linalg.norm(before - np.median(before, axis=0), axis=1))
+        spreadAfter = np.median(np.linalg.norm(after - np.median(after, axis=0), axis=1))
+        zoom = np.clip(spreadAfter / spreadBefore, 0.8, 1.25) if spreadBefore > 0 else 1.0
+        cx = (self.box[0] + self.box[2]) / 2.0 + shift[0]
+        cy = (self.box[1] + self.box[3]) / 2.0 + shift[1]
+        w = (self.box[2] - self.box[0]) * zoom / 2.0
+        h = (self.box[3] - self.box[1]) * zoom / 2.0
+        cx = cx % width
+        self.box = np.array([cx - w, cy - h, cx + w, cy + h])
+        self.seed(frame)
+        return self.box, self.confidence
+
+    def report(self):
+        return 'tracking: %d detector calls, %d tracked frames' % (self.detections, self.tracked)
+
+
+def check_lost_track(width=640, height=320, seed=0):
+    '''
+    An empty detection followed by a frame planned as tracked: track()
+    reports nothing instead of failing and the next frame is detected
+    '''
+    rng = np.random.RandomState(seed)
+    frame = rng.randint(0, 255, (height, width, 3)).astype(np.uint8)
+    tracker = SubjectTracker(interval=5)
+    boxes, scores = tracker.update(frame, np.array([[100.0, 80.0, 180.0, 240.0]]), np.array([[0.9]]))
+    tracked = tracker.track(frame)
+    plan = tracker.schedule(3)
+    empty = tracker.update(frame, None, None)
+    lost = tracker.track(frame)
+    return (tracked[0] is not None and plan == [False, False, False] and empty == (None, None)
+            and tracker.lost() and lost == (None, 0.0) and tracker.schedule(1) == [True])
+
+
+if __name__ == '__main__':
+    print('lost track: %s' % ('ok' if check_lost_track() else 'FAILED'))
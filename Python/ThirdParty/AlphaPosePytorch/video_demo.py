@@ -15,6 +15,7 @@ from SPPE.src.main_fast_inference import *
 
 from SPPE.src.utils.img import im_to_torch
 import os
+import sys
 from tqdm import tqdm
 import time
 from fn import getTime
@@ -22,11 +23,37 @@ import cv2
 
 from pPose_nms import pose_nms, write_json
 
-from rectifyimage import rectifyAround
+from rectifyimage import RectifyEngine
+from pipeline import Pipeline
+from framestore import FrameStore
+from checkpoint import StageManifest, fileSignature, hashItems
 
 args = opt
 args.dataset = 'coco'
 
+# options changing the results, a checkpoint made with other values is discarded
+_resultArgs = ('time_range', 'frame_stride', 'adaptive_stride', 'motion_thresh', 'det_interval', 'track_thresh',
+               'det_tiles', 'tile_fov', 'inp_dim', 'confidence', 'nms_thesh', 'fast_inference', 'kp_refine',
+               'rect_step', 'rect_interp', 'format', 'save_img')
+
+
+def resumable_frames(manifest, storePath):
+    '''
+    Number of leading frames of the store checkpointed with their outputs,
+    the frames after them are processed again, and the store metadata and
+    source frame of the last of them.
+    '''
+    if not FrameStore.exists(storePath):
+        return 0, None, None
+    store = FrameStore(storePath)
+    kept = 0
+    while kept < len(store) and manifest.isDone(store.meta[kept]['name'], hashItems(store.sourceFrame(kept))):
+        kept += 1
+    manifest.discard(manifest.frames()[kept:])
+    if not kept:
+        return 0, None, None
+    return kept, store.meta[kept - 1], store.sourceFrame(kept - 1)
+
 if __name__ == "__main__":
     videofile = args.video
     mode = args.mode
@@ -36,16 +63,38 @@ if __name__ == "__main__":
     if not len(videofile):
         raise IOError('Error: must contain --video')
 
+    # Frame level checkpoints, resuming relies on the frame store
+    manifest = None
+    resumeFrames, lastFrame, lastSource = 0, None, None
+    if args.framestore:
+        params = {'video': fileSignature(videofile), 'args': [(name, getattr(args, name)) for name in _resultArgs]}
+        manifest = StageManifest(args.outputpath, 'alphapose', params, restart=args.restart)
+        resumeFrames, lastFrame, lastSource = resumable_frames(manifest, os.path.join(args.outputpath, 'framestore'))
+        if manifest.complete and resumeFrames == len(manifest):
+            print('AlphaPose results in %s are up to date.' % args.outputpath)
+            manifest.close()
+            sys.exit(0)
+        if resumeFrames:
+            print('Resuming after %d checkpointed frames.' % resumeFrames)
+            if args.save_video:
+                print('Warning: the rendered video only contains the resumed frames.')
+
     # Load detection loader
     print('Loading YOLO model..')
-    test_loader = VideoDetectionLoader(videofile).start()
+    test_loader = VideoDetectionLoader(videofile)
     (fourcc,fps,frameSize) = test_loader.videoinfo()
     dim = 672
     rect_frameSize = (dim, dim)
+    rectifier = RectifyEngine(np.radians(args.rect_step), cacheSize=args.rect_cache,
+                              interpolation=args.rect_interp)
 
     # Data writer
     save_path = os.path.join(args.outputpath, 'AlphaPose_'+videofile.split('/')[-1].split('.')[0]+'.avi')
-    writer = DataWriter(args.save_video, save_path, 0, fps, rect_frameSize).start()
+    storeInfo = {'fps': fps * test_loader.stride, 'start_frame': test_loader.start_frame, 'stride': test_loader.stride}
+    if lastFrame is not None:
+        test_loader.resumeAfter(lastSource)
+    writer = DataWriter(args.save_video, save_path, 0, fps, rect_frameSize, storeInfo=storeInfo,
+                        sourceFrames=test_loader.sourceFrames, manifest=manifest, resumeFrames=resumeFrames)
 
     # Load pose model
     pose_dataset = Mscoco()
@@ -56,59 +105,61 @@ if __name__ == "__main__":
     pose_model.cuda()
     pose_model.eval()
 
-    runtime_profile = {
-        'ld': [],
-        'dt': [],
-        'dn': [],
-        'pt': [],
-        'pn': []
-    }
-
-    im_names_desc =  tqdm(range(test_loader.length()))
-    lastBox = np.zeros(4)
-    for i in im_names_desc:
-        start_time = getTime()
+    state = {'frame': resumeFrames, 'lastBox': np.zeros(4)}
+    if lastFrame is not None and lastFrame['boxes']:
+        state['lastBox'] = np.array(lastFrame['boxes'][0]).astype(int)
+
+    def rectify(item):
+        (inp, orig_img, boxes, scores) = item
+        im_name = str(state['frame']) + '.png'
+        state['frame'] += 1
+        if boxes is None or boxes.nelement() == 0:
+            rect_img, rot = rectifier.rectifyAround(orig_img, state['lastBox'], dim)
+            return (inp, None, None, rect_img, im_name, rot)
+        #Rectify image around first detected person
+        state['lastBox'] = np.array(boxes[0]).astype(int)
+        rect_img, rot = rectifier.rectifyAround(orig_img, state['lastBox'], dim)
+        return (inp, boxes, scores, rect_img, im_name, rot)
+
+    def estimate_pose(item):
+        (inp, boxes, scores, rect_img, im_name, rot) = item
+        if boxes is None:
+            return (None, None, None, None, None, rect_img, im_name, rot)
         with torch.no_grad():
-            # Human Detection
-            (inp, orig_img, boxes, scores) = test_loader.read()    
-            if boxes is None or boxes.nelement() == 0:
-                #writer.save(None, None, None, None, None, orig_img, im_name=str(i)+'.jpg')
-                rect_img, rot = rectifyAround(orig_img, lastBox, dim)
-                writer.save(None, None, None, None, None, rect_img, str(i)+'.png', rot)
-                continue
-            #Rectify image around first detected person
-            lastBox = np.array(boxes[0]).astype(int)
-            rect_img, rot = rectifyAround(orig_img, lastBox, dim)
-
-            #print("test loader:", test_loader.len())
-            ckpt_time, det_time = getTime(start_time)
-            runtime_profile['dt'].append(det_time)
-
-            # Pose Estimation
             inps, pt1, pt2 = crop_from_dets(inp, boxes)
             inps = Variable(inps.cuda())
-
             hm = pose_model(inps)
-            ckpt_time, pose_time = getTime(ckpt_time)
-            runtime_profile['pt'].append(pose_time)
-
-            writer.save(boxes, scores, hm, pt1, pt2, rect_img, str(i)+'.png', rot)
-            #print("writer:" , writer.len())
-            ckpt_time, post_time = getTime(ckpt_time)
-            runtime_profile['pn'].append(post_time)
-
-        # TQDM
-        im_names_desc.set_description(
-            'det time: {dt:.4f} | pose time: {pt:.4f} | post process: {pn:.4f}'.format(
-                dt=np.mean(runtime_profile['dt']), pt=np.mean(runtime_profile['pt']), pn=np.mean(runtime_profile['pn']))
-        )
+        return (boxes, scores, hm, pt1, pt2, rect_img, im_name, rot)
+
+    im_names_desc = tqdm(total=test_loader.length())
+
+    def write(item):
+        writer.write(item)
+        im_names_desc.update(1)
+
+    # decode -> detect -> rectify -> pose -> NMS -> write, one thread each
+    pipeline = Pipeline()
+    pipeline.source('decode', test_loader.frames())
+    pipeline.add('detect', test_loader.detect, queueSize=test_loader.detectQueueSize, batchSize=test_loader.batchSize)
+    pipeline.add('rectify', rectify)
+    pipeline.add('pose', estimate_pose)
+    pipeline.add('nms', writer.postprocess)
+    pipeline.add('write', write)
+    pipeline.start()
+    try:
+        pipeline.join()
+    finally:
+        im_names_desc.close()
+        writer.release()
 
     print('===========================> Finish Model Running.')
-    if (args.save_img or args.save_video) and not args.vis_fast:
-        print('===========================> Rendering remaining images in the queue...')
-        print('===========================> If this step takes too long, you can enable the --vis_fast flag to use fast rendering (real-time).')
-    while(writer.running()):
-        pass
-    writer.stop()
+    print(pipeline.report())
+    if test_loader.sampler is not None:
+        print(test_loader.sampler.report())
+    if test_loader.tracker is not None:
+        print(test_loader.tracker.report())
     final_result = writer.results()
     write_json(final_result, args.outputpath)
+    if manifest is not None:
+        manifest.markComplete()
+        manifest.close()
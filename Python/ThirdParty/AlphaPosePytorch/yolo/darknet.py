@@ -10,11 +10,11 @@ import matplotlib.pyplot as plt
 try:
     from util import count_parameters as count
     from util import convert2cpu as cpu
-    from util import predict_transform
+    from util import predict_transform, grid_offsets, decode_predictions
 except ImportError:
     from yolo.util import count_parameters as count
     from yolo.util import convert2cpu as cpu
-    from yolo.util import predict_transform
+    from yolo.util import predict_transform, grid_offsets, decode_predictions
 
 class test_net(nn.Module):
     def __init__(self, num_layers, input_size):
@@ -94,6 +94,8 @@ class DetectionLayer(nn.Module):
     def __init__(self, anchors):
         super(DetectionLayer, self).__init__()
         self.anchors = anchors
+        # grid offsets and scaled anchors by (grid size, device, dtype)
+        self.grids = {}
     
     def forward(self, x, inp_dim, num_classes, confidence):
         x = x.data
@@ -101,6 +103,17 @@ class DetectionLayer(nn.Module):
         prediction = x
         prediction = predict_transform(prediction, inp_dim, self.anchors, num_classes, confidence, CUDA)
         return prediction
+
+    def transform(self, x, inp_dim, num_classes):
+        # predict_transform with the offsets and anchors built once per input size,
+        # x is decoded in place
+        stride = inp_dim // x.size(2)
+        grid_size = inp_dim // stride
+        key = (grid_size, x.device, x.dtype)
+        if key not in self.grids:
+            self.grids[key] = grid_offsets(grid_size, self.anchors, stride, x.device, x.dtype)
+        x_y_offset, anchors = self.grids[key]
+        return decode_predictions(x, inp_dim, x_y_offset, anchors, num_classes)
         
 
         
@@ -355,7 +368,6 @@ class Darknet(nn.Module):
             
             elif module_type == 'yolo':        
                 
-                anchors = self.module_list[i][0].anchors
                 #Get the input dimensions
                 inp_dim = int (self.net_info["height"])
                 
@@ -364,7 +376,7 @@ class Darknet(nn.Module):
                 
                 #Output the result
                 x = x.data
-                x = predict_transform(x, inp_dim, anchors, num_classes, CUDA)
+                x = self.module_list[i][0].transform(x, inp_dim, num_classes)
                 
                 if type(x) == int:
                     continue
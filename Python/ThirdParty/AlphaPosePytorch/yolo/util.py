@@ -1,6 +1,7 @@
 
 from __future__ import division
 
+import time
 import torch 
 import torch.nn as nn
 import torch.nn.functional as F 
@@ -12,6 +13,10 @@ try:
     from bbox import bbox_iou
 except ImportError:
     from yolo.bbox import bbox_iou
+try:
+    from torchvision.ops import batched_nms
+except ImportError:
+    batched_nms = None
 
 
 def count_parameters(model):
@@ -26,60 +31,48 @@ def convert2cpu(matrix):
     else:
         return matrix
 
-def predict_transform(prediction, inp_dim, anchors, num_classes, CUDA = True):
+def grid_offsets(grid_size, anchors, stride, device=None, dtype=torch.float32):
+    # cell offsets (2, grid_size*grid_size) and anchors in cells (num_anchors, 2, 1),
+    # broadcast against predictions viewed as (batch, anchors, attrs, cells)
+    grid_len = np.arange(grid_size)
+    a,b = np.meshgrid(grid_len, grid_len)
+    x_y_offset = torch.FloatTensor(np.stack((a.ravel(), b.ravel())))
+    anchors = torch.FloatTensor([(a[0]/stride, a[1]/stride) for a in anchors]).unsqueeze(2)
+    return x_y_offset.to(device=device, dtype=dtype), anchors.to(device=device, dtype=dtype)
+
+def decode_predictions(prediction, inp_dim, x_y_offset, anchors, num_classes):
+    # decodes the raw head output in place, in its channel-major layout where
+    # every attribute is contiguous, then makes the one copy to
+    # (batch, cells*anchors, attrs)
     batch_size = prediction.size(0)
     stride =  inp_dim // prediction.size(2)
     grid_size = inp_dim // stride
     bbox_attrs = 5 + num_classes
-    num_anchors = len(anchors)
-    
-    anchors = [(a[0]/stride, a[1]/stride) for a in anchors]
+    num_anchors = anchors.size(0)
 
+    attrs = prediction.view(batch_size, num_anchors, bbox_attrs, grid_size*grid_size)
 
+    #Sigmoid the  centre_X, centre_Y, object confidencce and class scores
+    attrs[:,:,:2].sigmoid_()
+    attrs[:,:,4:5 + num_classes].sigmoid_()
 
-    prediction = prediction.view(batch_size, bbox_attrs*num_anchors, grid_size*grid_size)
-    prediction = prediction.transpose(1,2).contiguous()
-    prediction = prediction.view(batch_size, grid_size*grid_size*num_anchors, bbox_attrs)
-
-
-    #Sigmoid the  centre_X, centre_Y. and object confidencce
-    prediction[:,:,0] = torch.sigmoid(prediction[:,:,0])
-    prediction[:,:,1] = torch.sigmoid(prediction[:,:,1])
-    prediction[:,:,4] = torch.sigmoid(prediction[:,:,4])
-    
-
-    
     #Add the center offsets
-    grid_len = np.arange(grid_size)
-    a,b = np.meshgrid(grid_len, grid_len)
-    
-    x_offset = torch.FloatTensor(a).view(-1,1)
-    y_offset = torch.FloatTensor(b).view(-1,1)
-    
-    if CUDA:
-        x_offset = x_offset.cuda()
-        y_offset = y_offset.cuda()
-    
-    x_y_offset = torch.cat((x_offset, y_offset), 1).repeat(1,num_anchors).view(-1,2).unsqueeze(0)
-    
-    prediction[:,:,:2] += x_y_offset
-      
+    attrs[:,:,:2] += x_y_offset
+
     #log space transform height and the width
-    anchors = torch.FloatTensor(anchors)
-    
-    if CUDA:
-        anchors = anchors.cuda()
-    
-    anchors = anchors.repeat(grid_size*grid_size, 1).unsqueeze(0)
-    prediction[:,:,2:4] = torch.exp(prediction[:,:,2:4])*anchors
+    attrs[:,:,2:4].exp_()
+    attrs[:,:,2:4] *= anchors
 
-    #Softmax the class scores
-    prediction[:,:,5: 5 + num_classes] = torch.sigmoid((prediction[:,:, 5 : 5 + num_classes]))
+    attrs[:,:,:4] *= stride
 
-    prediction[:,:,:4] *= stride
-   
-    
-    return prediction
+    prediction = attrs.permute(0, 3, 1, 2).contiguous()
+    return prediction.view(batch_size, grid_size*grid_size*num_anchors, bbox_attrs)
+
+def predict_transform(prediction, inp_dim, anchors, num_classes, CUDA = True):
+    stride =  inp_dim // prediction.size(2)
+    grid_size = inp_dim // stride
+    x_y_offset, anchors = grid_offsets(grid_size, anchors, stride, prediction.device, prediction.dtype)
+    return decode_predictions(prediction.clone(), inp_dim, x_y_offset, anchors, num_classes)
 
 def load_classes(namesfile):
     fp = open(namesfile, "r")
@@ -102,19 +95,93 @@ def unique(tensor):
 
 
 def dynamic_write_results(prediction, confidence, num_classes, nms=True, nms_conf=0.4):
-    prediction_bak = prediction.clone()
-    dets = write_results(prediction.clone(), confidence, num_classes, nms, nms_conf)
+    # write_results leaves prediction untouched, no need to clone it
+    dets = write_results(prediction, confidence, num_classes, nms, nms_conf)
     if isinstance(dets, int):
         return dets
 
     if dets.shape[0] > 100:
         nms_conf -= 0.05
-        dets = write_results(prediction_bak.clone(), confidence, num_classes, nms, nms_conf)
+        dets = write_results(prediction, confidence, num_classes, nms, nms_conf)
 
     return dets
 
 
+def iou_matrix(boxes):
+    # IoU of every pair of (n, 4) x1 y1 x2 y2 boxes, same +1 convention as bbox_iou
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    inter_w = np.maximum(np.minimum(x2[:, None], x2[None]) - np.maximum(x1[:, None], x1[None]) + 1, 0)
+    inter_h = np.maximum(np.minimum(y2[:, None], y2[None]) - np.maximum(y1[:, None], y1[None]) + 1, 0)
+    inter = inter_w * inter_h
+    return inter / (area[:, None] + area[None] - inter)
+
+
+def nms_keep(boxes, nms_conf):
+    # greedy NMS of boxes sorted by decreasing confidence, scanning the upper
+    # triangle of the IoU matrix: a kept box suppresses the ones after it
+    suppress = np.triu(iou_matrix(boxes) >= nms_conf, 1)
+    keep = np.ones(len(boxes), dtype=bool)
+    for i in range(len(boxes)):
+        if keep[i]:
+            keep &= ~suppress[i]
+    return keep
+
+
 def write_results(prediction, confidence, num_classes, nms=True, nms_conf=0.4):
+    '''
+    Person detections of a batch of YOLO predictions, as rows of
+    (image index, x1, y1, x2, y2, objectness, class score, class) sorted by
+    image then decreasing objectness, or 0 when there is none.
+    Only the person class (0) is kept, so the other candidates are dropped
+    before sorting and NMS.
+    '''
+    # candidates over the objectness threshold, as (image, anchor) pairs
+    candidates = torch.nonzero(prediction[:,:,4] > confidence)
+    if candidates.numel() == 0:
+        return 0
+    image_pred = prediction[candidates[:,0], candidates[:,1]]
+
+    #Get the class having maximum score, and the index of that class
+    max_conf, max_conf_score = torch.max(image_pred[:,5:5+ num_classes], 1)
+    person = torch.nonzero(max_conf_score == 0).view(-1)
+    if person.numel() == 0:
+        return 0
+    candidates, image_pred, max_conf = candidates[person], image_pred[person], max_conf[person]
+
+    box_a = torch.cat((image_pred[:,0:1] - image_pred[:,2:3]/2,
+                       image_pred[:,1:2] - image_pred[:,3:4]/2,
+                       image_pred[:,0:1] + image_pred[:,2:3]/2,
+                       image_pred[:,1:2] + image_pred[:,3:4]/2), 1)
+
+    # by image, then decreasing objectness
+    image_ind = candidates[:,0].cpu().numpy()
+    objectness = image_pred[:,4].cpu().numpy()
+    order = np.lexsort((-objectness, image_ind))
+
+    if nms and batched_nms is not None:
+        sorted_ind = torch.from_numpy(order).to(prediction.device)
+        # +1 on x2 y2 gives the IoU of bbox_iou
+        boxes = box_a[sorted_ind] + box_a.new_tensor([0, 0, 1, 1])
+        kept = batched_nms(boxes, image_pred[sorted_ind, 4], candidates[sorted_ind, 0], nms_conf)
+        keep = np.zeros(len(order), dtype=bool)
+        keep[kept.cpu().numpy()] = True
+        order = order[keep]
+    elif nms:
+        boxes = box_a.cpu().numpy()[order]
+        image_ind = image_ind[order]
+        bounds = np.flatnonzero(np.diff(image_ind)) + 1
+        keep = np.concatenate([nms_keep(b, nms_conf) for b in np.split(boxes, bounds)])
+        order = order[keep]
+
+    index = torch.from_numpy(order).to(prediction.device)
+    output = torch.cat((candidates[:,0:1].type_as(image_pred), box_a, image_pred[:,4:5],
+                        max_conf.float().unsqueeze(1), max_conf.new_zeros(max_conf.shape).float().unsqueeze(1)), 1)
+    return output[index]
+
+
+def write_results_loop(prediction, confidence, num_classes, nms=True, nms_conf=0.4):
+    # reference implementation looping over images, classes and kept boxes, see benchmark_write_results
     conf_mask = (prediction[:,:,4] > confidence).float().unsqueeze(2)
     prediction = prediction*conf_mask
 
@@ -388,3 +455,57 @@ def write_results_half(prediction, confidence, num_classes, nms = True, nms_conf
                 output = torch.cat((output,out))
     
     return output
+
+
+def synthetic_predictions(batch_size, num_anchors=10647, num_classes=80, people=8, dups=6, inp_dim=608, seed=0):
+    '''
+    Random YOLO predictions (batch_size, num_anchors, 5 + num_classes) with
+    clusters of overlapping confident boxes around a few people per image
+    and low objectness everywhere else
+    '''
+    rng = np.random.RandomState(seed)
+    prediction = np.zeros((batch_size, num_anchors, 5 + num_classes), dtype=np.float32)
+    prediction[:, :, :2] = rng.uniform(0, inp_dim, (batch_size, num_anchors, 2))
+    prediction[:, :, 2:4] = rng.uniform(10, 200, (batch_size, num_anchors, 2))
+    prediction[:, :, 4] = rng.uniform(0, 0.1, (batch_size, num_anchors))
+    prediction[:, :, 5:] = rng.dirichlet(np.ones(num_classes), (batch_size, num_anchors))
+    for b in range(batch_size):
+        for p in range(people):
+            center = rng.uniform(50, inp_dim - 50, 2)
+            size = rng.uniform(30, 250, 2)
+            anchors = rng.choice(num_anchors, dups, replace=False)
+            prediction[b, anchors, :2] = center + rng.normal(0, 0.1, (dups, 2)) * size
+            prediction[b, anchors, 2:4] = size * rng.uniform(0.8, 1.2, (dups, 2))
+            prediction[b, anchors, 4] = rng.uniform(0.05, 1, dups)
+            # mostly people, a few other classes
+            prediction[b, anchors, 5 + (0 if rng.uniform() < 0.8 else rng.randint(1, num_classes))] += 1
+    return torch.from_numpy(prediction)
+
+
+def benchmark_write_results(batch_sizes=(1, 4, 16), confidences=(0.05, 0.2, 0.5), nms_confs=(0.3, 0.4, 0.6)):
+    '''
+    Check write_results against the loop reference and time both on the CPU
+    '''
+    for batch_size in batch_sizes:
+        for confidence in confidences:
+            for nms_conf in nms_confs:
+                prediction = synthetic_predictions(batch_size, seed=batch_size)
+                start = time.time()
+                dets = write_results(prediction, confidence, 80, nms=True, nms_conf=nms_conf)
+                fast_time = time.time() - start
+                start = time.time()
+                ref = write_results_loop(prediction.clone(), confidence, 80, nms=True, nms_conf=nms_conf)
+                loop_time = time.time() - start
+                if isinstance(dets, int) or isinstance(ref, int):
+                    same = isinstance(dets, int) and isinstance(ref, int)
+                    ndets = 0
+                else:
+                    same = dets.shape == ref.shape and torch.allclose(dets, ref)
+                    ndets = dets.shape[0]
+                print('batch %2d | conf %.2f | nms %.2f | %4d dets | loop %8.2f ms | vectorized %7.2f ms | %s' % (
+                    batch_size, confidence, nms_conf, ndets, 1000 * loop_time, 1000 * fast_time,
+                    'same' if same else 'DIFFERENT'))
+
+
+if __name__ == '__main__':
+    benchmark_write_results()
@@ -7,9 +7,32 @@ import scipy
 import scipy.misc
 import scipy.cluster
 import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AlphaPosePytorch'))
+from framestore import FrameStore
+from checkpoint import StageManifest, hashItems, hashFile
 
 _atlasDim = 255
-_numberOfFrames = int(len([name for name in os.listdir('./results/')])/3)
+_frameStorePath = '../AlphaPosePytorch/results/framestore'
+_checkpointPath = './texture_checkpoint'
+_checkpointEvery = 25
+# confidence weights, see FrameWeights
+_minWeight = 0.05
+_fullResolutionFov = np.radians(30)
+_sharpnessReference = 100.0
+_coveredWeight = 1.0
+# samples a texel needs for the variance of its color to be estimated
+_minSamples = 2
+
+def GetFrameIndices() :
+    # frames with a DensePose result, the other files of results/ are not counted
+    stems = [name[:-len('_IUV.png')] for name in os.listdir('./results/') if name.endswith('_IUV.png')]
+    return sorted(int(stem) for stem in stems if stem.isdigit())
 
 def DrawOnAtlas(atlas, tex, minV, maxV, minU, maxU, v, u) :
     tempV = minV + ((255-v)*((maxV-minV-1)/255.0)).astype(int)
@@ -19,7 +42,7 @@ def DrawOnAtlas(atlas, tex, minV, maxV, minU, maxU, v, u) :
 def GrowTextureIntoZeros(tex, kernelVal, iters) :
     for i in range(iters) :
         indicesWhereNotZero = np.where(np.sum(tex, axis=2) != 0)
-        nonZeroMask = np.zeros(tex.shape[:2], dtype=np.bool)
+        nonZeroMask = np.zeros(tex.shape[:2], dtype=bool)
         nonZeroMask[indicesWhereNotZero] = True
         alphaMask = np.zeros(tex.shape)
         alphaMask[np.where(nonZeroMask==True)] = 1
@@ -75,23 +98,234 @@ def FillWithDominantColor(atlas) :
             indicesY = np.concatenate((indicesY, _atlasDim*j+indicesWhereZero[0]))
             indicesX = np.concatenate((indicesX, _atlasDim*i+indicesWhereZero[1]))
             tex = np.hstack((tex, temp))
+        if len(indicesY) == 0 :
+            continue
         dominantCol = GetDominantColor(tex)
         outTex[indicesY.astype(int), indicesX.astype(int)] = dominantCol
     return outTex
 
-def GetTextureAtlasFrom(texIm, IUV) :
-    U = IUV[:,:,1]
-    V = IUV[:,:,2]
-    atlas = np.zeros((6*_atlasDim,4*_atlasDim,3))
-    for i in range(4) :
-        for j in range(6) :
-            pixelsForPart = np.where(IUV[:,:,0]==6*i+j+1)
-            if len(pixelsForPart[0]) > 0 :
-                drawTex = (texIm[:,:,::-1]/255.)[pixelsForPart[0],pixelsForPart[1]] 
-                texU = 255*(1-U[pixelsForPart])
-                texV = 255*(1-V[pixelsForPart])
-                DrawOnAtlas(atlas, drawTex, _atlasDim*j, _atlasDim*(j+1), _atlasDim*i, _atlasDim*(i+1), texV, texU)
-    return atlas
+def GetAtlasLookup() :
+    # flat atlas offset of the tile of each part index (-1 for the background)
+    # and of the texel row and column of each V and U value, with the same
+    # rounding as DrawOnAtlas applied to the uint8 IUV channels
+    parts = np.arange(25)
+    tileOffsets = np.where(parts > 0, _atlasDim*((parts-1)%6)*4*_atlasDim + _atlasDim*((parts-1)//6), -1)
+    values = np.arange(256).astype(np.uint8)
+    texU = 255*(1-values)
+    texV = 255*(1-values)
+    rowOffsets = ((255-texV)*((_atlasDim-1)/255.0)).astype(int) * 4*_atlasDim
+    colOffsets = (texU*((_atlasDim-1)/255.0)).astype(int)
+    return tileOffsets, rowOffsets, colOffsets
+
+_atlasLookup = GetAtlasLookup()
+
+def ViewAngleWeights(IUV) :
+    # cosine of the view angle estimated from the UV gradient: the ratio of
+    # the singular values of d(U,V)/d(x,y), 1 for a surface facing the camera
+    # and towards 0 at grazing angles. Pixels next to another part get the
+    # lowest weight, their gradient mixes two charts.
+    U = cv2.GaussianBlur(IUV[:,:,1].astype(np.float32), (5,5), 0)
+    V = cv2.GaussianBlur(IUV[:,:,2].astype(np.float32), (5,5), 0)
+    Uy, Ux = np.gradient(U)
+    Vy, Vx = np.gradient(V)
+    squares = Ux**2 + Uy**2 + Vx**2 + Vy**2
+    det = Ux*Vy - Uy*Vx
+    disc = np.sqrt(np.maximum(squares**2 - 4*det**2, 0))
+    ratio = np.sqrt(np.maximum(squares - disc, 0) / np.maximum(squares + disc, 1e-6))
+    ratio[squares == 0] = 1
+    kernel = np.ones((5,5), np.uint8)
+    interior = cv2.erode(IUV[:,:,0], kernel) == cv2.dilate(IUV[:,:,0], kernel)
+    return np.where(interior, np.clip(ratio, _minWeight, 1), _minWeight).astype(np.float32)
+
+def DistanceWeight(d, dim) :
+    # d of rectifyAround: the farther the person, the fewer source pixels per
+    # crop pixel. Views where the person spans _fullResolutionFov or more weigh 1.
+    if d is None :
+        return 1.0
+    personHeight = 175.0 * dim / 224
+    return min(1.0, personHeight / (2 * np.tan(_fullResolutionFov/2.0)) / d)
+
+def SharpnessWeight(texIm, body) :
+    # variance of the Laplacian over the body, low for motion blur and defocus
+    if not body.any() :
+        return 0.0
+    laplacian = cv2.Laplacian(cv2.cvtColor(np.ascontiguousarray(texIm), cv2.COLOR_BGR2GRAY), cv2.CV_32F)
+    variance = float(laplacian[body].var())
+    return variance / (variance + _sharpnessReference)
+
+def FrameWeights(texIm, IUV, body, d=None) :
+    # confidence of every body pixel of a frame
+    frameWeight = DistanceWeight(d, texIm.shape[1]) * SharpnessWeight(texIm, body)
+    return ViewAngleWeights(IUV)[body] * np.float32(max(frameWeight, _minWeight))
+
+def GetAtlasParts() :
+    # part index of every texel of the atlas
+    rows, cols = np.mgrid[0:6*_atlasDim, 0:4*_atlasDim]
+    return 6*(cols//_atlasDim) + rows//_atlasDim + 1
+
+_atlasParts = GetAtlasParts()
+
+class TextureAccumulator :
+    '''
+    Texture atlas built from (image, IUV) pairs as they arrive. The float32
+    buffers kept for the whole clip are the weighted color sums (RGB, 0-255),
+    weights, squared color sums and sample counts of every texel, plus the
+    best sample of every texel for the best view fusion. Samples weigh 1 for
+    the mean fusion and their confidence (FrameWeights) otherwise.
+    Coverage is the fraction of the texels of uvMask with a summed weight of
+    at least _coveredWeight and at least _minSamples samples, so that a
+    single sample does not pass for a texel without error, error the
+    standard error of their mean color.
+    converged() tells when the coverage and error targets are met, or when
+    the coverage gained since the previous call is under minGain, a target
+    of 0 being ignored.
+    '''
+    def __init__(self, fusion='mean', uvMask=None, coverageTarget=0.0, errorTarget=0.0, minGain=0.0) :
+        self.fusion = fusion
+        self.uvMask = uvMask if uvMask is not None else np.ones((6*_atlasDim, 4*_atlasDim), dtype=bool)
+        self.coverageTarget = coverageTarget
+        self.errorTarget = errorTarget
+        self.minGain = minGain
+        self.reset()
+
+    def reset(self) :
+        shape = (6*_atlasDim, 4*_atlasDim)
+        self.buffers = {
+            'texSum': np.zeros(shape + (3,), dtype=np.float32),
+            'texWeight': np.zeros(shape, dtype=np.float32),
+            'texSquares': np.zeros(shape, dtype=np.float32),
+            'texCount': np.zeros(shape, dtype=np.float32),
+        }
+        if self.fusion == 'best' :
+            self.buffers['bestColor'] = np.zeros(shape + (3,), dtype=np.float32)
+            self.buffers['bestWeight'] = np.zeros(shape, dtype=np.float32)
+        self.frames = []
+        self.lastCoverage = None
+
+    def __len__(self) :
+        return len(self.frames)
+
+    def add(self, frame, texIm, IUV, d=None) :
+        # adds every body pixel of the frame to the texel it maps to
+        tileOffsets, rowOffsets, colOffsets = _atlasLookup
+        parts = IUV[:,:,0]
+        body = (parts > 0) & (parts <= 24)
+        texels = tileOffsets[parts[body]] + rowOffsets[IUV[:,:,2][body]] + colOffsets[IUV[:,:,1][body]]
+        colors = texIm[body][:,::-1].astype(np.float32)
+        if self.fusion == 'mean' :
+            weights = np.ones(len(texels), dtype=np.float32)
+            weighted = colors
+        else :
+            weights = FrameWeights(texIm, IUV, body, d)
+            weighted = colors * weights[:,None]
+        np.add.at(self.buffers['texSum'].reshape(-1), (3*texels[:,None] + np.arange(3)).ravel(), weighted.ravel())
+        np.add.at(self.buffers['texWeight'].reshape(-1), texels, weights)
+        np.add.at(self.buffers['texSquares'].reshape(-1), texels, (weighted*colors).sum(axis=1))
+        np.add.at(self.buffers['texCount'].reshape(-1), texels, 1)
+        if self.fusion == 'best' :
+            # highest weight sample of every texel of the frame, if better than the stored one
+            order = np.lexsort((weights, texels))
+            last = np.append(texels[order][1:] != texels[order][:-1], True)
+            order = order[last]
+            bestWeight = self.buffers['bestWeight'].reshape(-1)
+            better = order[weights[order] > bestWeight[texels[order]]]
+            bestWeight[texels[better]] = weights[better]
+            self.buffers['bestColor'].reshape(-1, 3)[texels[better]] = colors[better]
+        self.frames.append(str(frame))
+
+    def merge(self, other) :
+        # adds the frames of other, e.g. the partial accumulator of a worker
+        self.buffers['texSum'] += other.buffers['texSum']
+        self.buffers['texWeight'] += other.buffers['texWeight']
+        self.buffers['texSquares'] += other.buffers['texSquares']
+        self.buffers['texCount'] += other.buffers['texCount']
+        if self.fusion == 'best' :
+            better = other.buffers['bestWeight'] > self.buffers['bestWeight']
+            self.buffers['bestWeight'][better] = other.buffers['bestWeight'][better]
+            self.buffers['bestColor'][better] = other.buffers['bestColor'][better]
+        self.frames.extend(other.frames)
+
+    def texture(self) :
+        # float64 atlas in [0, 1], black where no frame contributed and outside of uvMask
+        outTex = np.zeros(self.buffers['texSum'].shape)
+        if self.fusion == 'best' :
+            covered = (self.buffers['bestWeight'] > 0) & self.uvMask
+            outTex[covered] = self.buffers['bestColor'][covered] / 255.0
+            return outTex
+        texWeight = self.buffers['texWeight']
+        covered = (texWeight > 0) & self.uvMask
+        outTex[covered] = self.buffers['texSum'][covered] / (255.0 * texWeight[covered][:,None])
+        return outTex
+
+    def known(self) :
+        # texels of uvMask with at least one sample, the others are holes to fill
+        weight = self.buffers['bestWeight'] if self.fusion == 'best' else self.buffers['texWeight']
+        return (weight > 0) & self.uvMask
+
+    def writeAtlas(self, path) :
+        # intermediate atlas, before the holes are filled
+        cv2.imwrite(path, np.round(255.0 * self.texture()[:,:,::-1]).astype(np.uint8))
+
+    def covered(self) :
+        return (self.buffers['texWeight'] >= _coveredWeight) & (self.buffers['texCount'] >= _minSamples) & self.uvMask
+
+    def errors(self, covered) :
+        # standard error of the mean color of the covered texels
+        texWeight = self.buffers['texWeight'][covered]
+        mean = self.buffers['texSum'][covered] / texWeight[:,None]
+        variance = np.maximum(self.buffers['texSquares'][covered] / texWeight - (mean**2).sum(axis=1), 0)
+        return np.sqrt(variance / texWeight)
+
+    def coverage(self) :
+        return float(self.covered().sum()) / max(1, self.uvMask.sum())
+
+    def error(self) :
+        covered = self.covered()
+        return float(self.errors(covered).mean()) if covered.any() else float('inf')
+
+    def partStatistics(self) :
+        # coverage and mean error of the 24 parts
+        covered = self.covered()
+        parts = _atlasParts[self.uvMask]
+        texels = np.bincount(parts, minlength=25)[1:]
+        coverage = np.bincount(_atlasParts[covered], minlength=25)[1:] / np.maximum(texels, 1.0)
+        errorSums = np.bincount(_atlasParts[covered], self.errors(covered), minlength=25)[1:]
+        error = np.where(coverage > 0, errorSums / np.maximum(coverage*texels, 1.0), np.inf)
+        return coverage, error
+
+    def converged(self) :
+        coverage = self.coverage()
+        gain = coverage - self.lastCoverage if self.lastCoverage is not None else None
+        self.lastCoverage = coverage
+        if self.minGain > 0 and gain is not None and gain < self.minGain :
+            return True
+        if self.coverageTarget <= 0 and self.errorTarget <= 0 :
+            return False
+        return coverage >= self.coverageTarget and (self.errorTarget <= 0 or self.error() <= self.errorTarget)
+
+    def report(self) :
+        coverage, error = self.partStatistics()
+        lines = ['texture: %d frames, %.1f%% coverage, error %.1f' % (len(self), 100*self.coverage(), self.error())]
+        for part in range(24) :
+            lines.append('  part %2d: %5.1f%% coverage, error %.1f' % (part+1, 100*coverage[part], error[part]))
+        return '\n'.join(lines)
+
+    def save(self, path) :
+        tmpPath = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmpPath, frames=np.array(self.frames, dtype=int), **self.buffers)
+        if os.path.exists(path) :
+            os.remove(path)
+        os.rename(tmpPath, path)
+
+    def load(self, path) :
+        # False when the file misses buffers of this fusion
+        data = np.load(path)
+        if any(name not in data.files for name in self.buffers) :
+            return False
+        for name in self.buffers :
+            self.buffers[name][...] = data[name]
+        self.frames = [str(frame) for frame in data['frames']]
+        return True
 
 def DrawBaseAtlas() :
     ALP_UV = loadmat('UV_data/UV_Processed.mat')
@@ -125,29 +359,334 @@ def PiecewiseBlur(atlas) :
             tex = cv2.medianBlur(tex,9)
             atlas[_atlasDim*j:_atlasDim*(j+1),_atlasDim*i:_atlasDim*(i+1),:] = tex / 255.0
     
-def GetSummedTexture(frameCount) :
-    alphaMask = np.zeros((6*_atlasDim,4*_atlasDim,3))
-    for i in range(frameCount) :
-        imgIndex = str(i)
-        IUV = cv2.imread('results/' + imgIndex + '_IUV.png')
-        img = cv2.imread('input_data/' + imgIndex + '.png')
-        tempTex = GetTextureAtlasFrom(img, IUV)
-        indicesWhereNotZero = np.where(np.sum(tempTex, axis=2) != 0)
-        alphaMask[indicesWhereNotZero] += 1
-        if i == 0 :
-            outTex = tempTex
-        else :
-            outTex += tempTex
-        print('Finished frame ' + str(i) + '.\r')
-    alphaNotZero = np.where(alphaMask != 0)
-    outTex[alphaNotZero] *= 1.0/alphaMask[alphaNotZero]
+def AtlasTiles(atlas) :
+    # (6*dim, 4*dim, ...) atlas to (24, dim, dim, ...) tiles in part order
+    tiles = atlas.reshape((6, _atlasDim, 4, _atlasDim) + atlas.shape[2:]).swapaxes(1, 2).swapaxes(0, 1)
+    return tiles.reshape((24, _atlasDim, _atlasDim) + atlas.shape[2:])
+
+def TilesAtlas(tiles) :
+    atlas = tiles.reshape((4, 6, _atlasDim, _atlasDim) + tiles.shape[3:]).swapaxes(0, 1).swapaxes(1, 2)
+    return atlas.reshape((6*_atlasDim, 4*_atlasDim) + tiles.shape[3:])
+
+def UpsampleTiles(tiles) :
+    # x2 bilinear upsampling of every (n, size, size, 3) tile on its own, edges replicated
+    n, size = tiles.shape[:2]
+    upsampled = np.empty((n, 2*size, 2*size, 3), dtype=np.float32)
+    for k in range(n) :
+        upsampled[k] = cv2.resize(tiles[k], (2*size, 2*size), interpolation=cv2.INTER_LINEAR)
+    return upsampled
+
+def PushPullFill(tiles, known) :
+    # pull: pyramid of the premultiplied colors and known weights, tiles padded
+    # to a power of two so that every 2x2 block stays inside its tile;
+    # push: from the coarsest level, every level is blended over the upsampled
+    # coarser one by its weight, so known texels are kept as they are
+    # (the colors are premultiplied by the weights)
+    n, dim = tiles.shape[:2]
+    size = 1
+    while size < dim :
+        size *= 2
+    weight = np.zeros((n, size, size, 1), dtype=np.float32)
+    weight[:, :dim, :dim, 0] = known
+    color = np.zeros((n, size, size, 3), dtype=np.float32)
+    color[:, :dim, :dim] = tiles
+    color *= weight
+    pyramid = [(color, weight)]
+    while size > 1 :
+        size //= 2
+        # a coarse texel is fully known as soon as its 2x2 block holds a whole known texel
+        color = color.reshape(n, size, 2, size, 2, 3).sum(axis=(2, 4))
+        total = weight.reshape(n, size, 2, size, 2, 1).sum(axis=(2, 4))
+        weight = np.minimum(total, 1)
+        color *= weight / np.maximum(total, 1e-12)
+        pyramid.append((color, weight))
+    filled = color / np.maximum(weight, 1e-12)
+    for color, weight in pyramid[-2::-1] :
+        filled = UpsampleTiles(filled)
+        filled *= 1 - weight
+        filled += color
+    return filled[:, :dim, :dim]
+
+def NearestFill(tiles, known, blur=11) :
+    # color of the nearest known texel of the tile (distance transform labels),
+    # blurred over the holes to soften the Voronoi cells
+    filled = tiles.copy()
+    for k in range(len(tiles)) :
+        if not known[k].any() or known[k].all() :
+            continue
+        _, labels = cv2.distanceTransformWithLabels((~known[k]).astype(np.uint8), cv2.DIST_L2, 5,
+                                                    labelType=cv2.DIST_LABEL_PIXEL)
+        palette = np.zeros((labels.max()+1, 3), dtype=np.float32)
+        palette[labels[known[k]]] = tiles[k][known[k]]
+        nearest = cv2.blur(palette[labels], (blur, blur))
+        filled[k][~known[k]] = nearest[~known[k]]
+    return filled
+
+def FillAtlasHoles(atlas, known=None, method='pushpull') :
+    '''
+    Fills the texels of the atlas that are not known (default: black ones)
+    from the known texels of the same part, on all the tiles at once in float32.
+    Tiles without any known texel are left black.
+    '''
+    if known is None :
+        known = np.sum(atlas, axis=2) != 0
+    tiles = AtlasTiles(np.asarray(atlas, dtype=np.float32))
+    knownTiles = AtlasTiles(known)
+    if method == 'pushpull' :
+        filled = PushPullFill(tiles, knownTiles)
+    else :
+        filled = NearestFill(tiles, knownTiles)
+    filled[~knownTiles.any(axis=(1, 2))] = 0
+    return TilesAtlas(filled)
+
+def benchmark(holeFraction=0.3, repeats=3) :
+    '''
+    Runtime, peak numpy memory and error on held-out texels of the hole
+    filling functions. The atlas of the texture checkpoint is used when
+    there is one, otherwise a smooth synthetic atlas. Texels of random
+    blobs are removed and compared with the filled values (RMSE, 0-255,
+    over the held-out texels the function filled).
+    '''
+    try :
+        import tracemalloc
+    except ImportError :
+        tracemalloc = None
+    rng = np.random.RandomState(0)
+    path = os.path.join(_checkpointPath, 'accumulator.npz')
+    accumulator = TextureAccumulator('mean', LoadUVMask())
+    if os.path.exists(path) and accumulator.load(path) :
+        reference, known = accumulator.texture(), accumulator.known()
+    else :
+        rows, cols = np.mgrid[0:6*_atlasDim, 0:4*_atlasDim] / float(_atlasDim)
+        reference = np.dstack([0.5 + 0.4*np.sin(2.1*rows + k) * np.cos(1.7*cols - k) for k in range(3)])
+        known = np.ones(rows.shape, dtype=bool)
+    blobs = cv2.GaussianBlur(rng.rand(*known.shape).astype(np.float32), (0, 0), 8)
+    heldOut = known & (blobs < np.percentile(blobs[known], 100*holeFraction))
+    holed = reference * (known & ~heldOut)[:,:,None]
+
+    def piecewiseGrow() :
+        tex = holed.copy()
+        PiecewiseGrowIntoZeros(tex, 3, 3)
+        return tex
+    methods = [
+        ('GrowTextureIntoZeros 3x3', piecewiseGrow),
+        ('ExpandVoronoi', lambda: ExpandVoronoi(holed.copy(), 0)),
+        ('FillAtlasHoles nearest', lambda: FillAtlasHoles(holed, known & ~heldOut, 'nearest')),
+        ('FillAtlasHoles pushpull', lambda: FillAtlasHoles(holed, known & ~heldOut, 'pushpull')),
+    ]
+    print('%d held-out texels' % heldOut.sum())
+    for name, fn in methods :
+        start = time.time()
+        for _ in range(repeats) :
+            filled = fn()
+        elapsed = (time.time() - start) / repeats
+        peak = float('nan')
+        if tracemalloc is not None :
+            tracemalloc.start()
+            fn()
+            peak = tracemalloc.get_traced_memory()[1] / 2.0**20
+            tracemalloc.stop()
+        done = heldOut & (np.sum(filled, axis=2) != 0)
+        error = 255 * np.sqrt(np.mean((filled[done] - reference[done])**2)) if done.any() else float('nan')
+        print('%-24s | %8.1f ms | %7.1f MB | %5.1f%% filled | RMSE %5.1f' % (
+            name, 1000*elapsed, peak, 100.0*done.sum()/heldOut.sum(), error))
+
+def LoadCheckpoint(accumulator, manifest, frameIndices, store) :
+    # restores the accumulator of the checkpoint if all its frames are still valid
+    path = os.path.join(_checkpointPath, 'accumulator.npz')
+    if not os.path.exists(path) or not accumulator.load(path) :
+        return False
+    available = set(str(i) for i in frameIndices)
+    if any(frame not in available or not manifest.isDone(frame, FrameHash(store, int(frame))) for frame in accumulator.frames) :
+        print('Texture checkpoint is stale, starting over.')
+        accumulator.reset()
+        return False
+    return True
+
+def SaveCheckpoint(accumulator, preview=False) :
+    accumulator.save(os.path.join(_checkpointPath, 'accumulator.npz'))
+    if preview :
+        accumulator.writeAtlas(os.path.join(_checkpointPath, 'atlas_preview.png'))
+
+def OpenFrameStore() :
+    return FrameStore(_frameStorePath) if FrameStore.exists(_frameStorePath) else None
+
+def LoadCrop(store, i) :
+    if store is not None :
+        return store.frame(store.index(str(i) + '.png'))
+    return cv2.imread('input_data/' + str(i) + '.png')
+
+def FrameHash(store, i, img=None) :
+    # input hash of frame i, its IUV file and crop
+    if img is None :
+        img = LoadCrop(store, i)
+    return hashItems(hashFile('results/' + str(i) + '_IUV.png'), img)
+
+def LoadFrame(store, i) :
+    # IUV, crop, d of the crop view (None without a store) and input hash of frame i
+    img = LoadCrop(store, i)
+    d = store.cameraRot(store.index(str(i) + '.png'))[0] if store is not None else None
+    return cv2.imread('results/' + str(i) + '_IUV.png'), img, d, FrameHash(store, i, img)
+
+def LoadUVMask() :
     uvMask = cv2.imread('../../../Assets/SMPL/Samples/Materials/UVMask.png')
-    outTex[np.where(uvMask == 0)] = 0
-    return outTex
+    return uvMask.any(axis=2) if uvMask is not None else None
+
+_workerStore = None
+
+def InitWorker() :
+    # every worker memory-maps the store on its own
+    global _workerStore
+    _workerStore = OpenFrameStore()
+
+def AccumulateShard(shard) :
+    # partial accumulator of a shard of frames, only it goes back to the main process
+    frames, fusion = shard
+    accumulator = TextureAccumulator(fusion)
+    hashes = []
+    for i in frames :
+        IUV, img, d, inputHash = LoadFrame(_workerStore, i)
+        accumulator.add(i, img, IUV, d)
+        hashes.append(inputHash)
+    return accumulator, hashes
+
+def TreeReduce(partials) :
+    # pairwise merges of accumulators, in place into the first of each pair
+    while len(partials) > 1 :
+        for k in range(0, len(partials)-1, 2) :
+            partials[k].merge(partials[k+1])
+        partials = partials[::2]
+    return partials[0]
+
+def SplitShards(frames, count) :
+    # contiguous shards of about the same size
+    bounds = np.linspace(0, len(frames), count+1).astype(int)
+    return [frames[bounds[k]:bounds[k+1]] for k in range(count) if bounds[k] < bounds[k+1]]
+
+def GetInputIndices() :
+    stems = [name[:-len('.png')] for name in os.listdir('./input_data/') if name.endswith('.png')]
+    return sorted(int(stem) for stem in stems if stem.isdigit())
+
+def ResultReady(i, settle=1.0) :
+    # both DensePose outputs of frame i exist and are no longer being written
+    paths = ['results/' + str(i) + '_IUV.png', 'results/' + str(i) + '_INDS.png']
+    return all(os.path.exists(path) and time.time() - os.path.getmtime(path) > settle for path in paths)
+
+def ArrivingFrames(expected, pollInterval=2.0, idleTimeout=600.0) :
+    # yields the expected frames as DensePose writes their results, to run
+    # while inference goes on; gives up after idleTimeout seconds without a new one
+    remaining = set(expected)
+    lastArrival = time.time()
+    while remaining :
+        ready = sorted(i for i in remaining if ResultReady(i))
+        for i in ready :
+            remaining.discard(i)
+            yield i
+        if ready :
+            lastArrival = time.time()
+        elif time.time() - lastArrival > idleTimeout :
+            print('No new DensePose result for ' + str(int(idleTimeout)) + ' s, ' + str(len(remaining)) + ' frames missing.')
+            return
+        else :
+            time.sleep(pollInterval)
+
+def GetSummedTexture(accumulator, frames=None, restart=False, workers=1, preview=False) :
+    # consumes the frames (indices, default all the DensePose results) until
+    # the accumulator converges, returns its texture
+    available = GetFrameIndices()
+    if frames is None :
+        frames = available
+    store = OpenFrameStore()
+    # the accumulator is checkpointed with the frames it includes, a rerun
+    # only adds the new frames unless an included one changed
+    manifest = StageManifest(_checkpointPath, 'texture', {'atlasDim': _atlasDim, 'fusion': accumulator.fusion}, restart)
+    if not restart and LoadCheckpoint(accumulator, manifest, available, store) :
+        print('Resuming from ' + str(len(accumulator)) + ' checkpointed frames.')
+    done = set(accumulator.frames)
+    pendingFrames = (i for i in frames if str(i) not in done)
+    def Checkpoint() :
+        SaveCheckpoint(accumulator, preview)
+        print('Coverage ' + str(round(100*accumulator.coverage(), 1)) + '%.')
+        if accumulator.converged() :
+            print('Texture converged, skipping the remaining frames.')
+            return True
+        return False
+    accumulator.converged()
+    if workers > 1 :
+        # map/reduce over rounds of frames, the accumulator is checkpointed after each round
+        pool = multiprocessing.Pool(workers, InitWorker)
+        while True :
+            batch = list(itertools.islice(pendingFrames, workers*_checkpointEvery))
+            if not batch :
+                break
+            results = pool.map(AccumulateShard, [(shard, accumulator.fusion) for shard in SplitShards(batch, workers)])
+            partial = TreeReduce([partial for partial, _ in results])
+            inputHashes = [inputHash for _, shardHashes in results for inputHash in shardHashes]
+            for frame, inputHash in zip(partial.frames, inputHashes) :
+                manifest.record(frame, inputHash, ['accumulator.npz'])
+            accumulator.merge(partial)
+            print('Finished frames ' + str(batch[0]) + ' to ' + str(batch[-1]) + '.')
+            if Checkpoint() :
+                break
+        pool.close()
+        pool.join()
+    else :
+        pending = 0
+        for i in pendingFrames :
+            IUV, img, d, inputHash = LoadFrame(store, i)
+            accumulator.add(i, img, IUV, d)
+            manifest.record(i, inputHash, ['accumulator.npz'])
+            pending += 1
+            print('Finished frame ' + str(i) + '.\r')
+            if pending == _checkpointEvery :
+                pending = 0
+                if Checkpoint() :
+                    break
+    SaveCheckpoint(accumulator, preview)
+    manifest.markComplete()
+    manifest.close()
+    print(accumulator.report())
+    return accumulator.texture()
 
 if __name__ == "__main__":
-    outTex = GetSummedTexture(_numberOfFrames)
-    PiecewiseGrowIntoZeros(outTex, 3, 3)
+    parser = argparse.ArgumentParser(description='Texture atlas from the DensePose results')
+    parser.add_argument('--restart', default=False, action='store_true',
+                        help='ignore the texture checkpoint and accumulate every frame again')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes accumulating frames in parallel, 0 for one per core')
+    parser.add_argument('--fusion', default='mean', choices=['mean', 'weighted', 'best'],
+                        help='mean of all the samples of a texel, mean weighted by the view angle, '
+                             'distance and sharpness of the frames, or the best weighted sample')
+    parser.add_argument('--min_gain', type=float, default=0.0,
+                        help='stop when a checkpoint adds less than this fraction of confidently covered '
+                             'texels, 0 uses every frame')
+    parser.add_argument('--coverage', type=float, default=0.0,
+                        help='stop once this fraction of the texels is confidently covered '
+                             '(and --max_error is met), 0 uses every frame')
+    parser.add_argument('--max_error', type=float, default=0.0,
+                        help='with --coverage, also wait for the mean standard error of the covered texel colors '
+                             '(0-255) to fall under this value')
+    parser.add_argument('--follow', default=False, action='store_true',
+                        help='consume the frames of input_data as DensePose writes their results, '
+                             'to run alongside inference')
+    parser.add_argument('--idle_timeout', type=float, default=600.0,
+                        help='with --follow, seconds without a new result before giving up')
+    parser.add_argument('--preview', default=False, action='store_true',
+                        help='write the atlas at every checkpoint to ' + _checkpointPath + '/atlas_preview.png')
+    parser.add_argument('--fill', default='pushpull', choices=['pushpull', 'nearest'],
+                        help='hole filling of the atlas, push-pull inpainting or nearest known texel')
+    parser.add_argument('--benchmark', default=False, action='store_true',
+                        help='compare the hole filling functions and exit')
+    args = parser.parse_args()
+    if args.benchmark :
+        benchmark()
+        sys.exit(0)
+    workers = args.workers if args.workers > 0 else multiprocessing.cpu_count()
+    accumulator = TextureAccumulator(args.fusion, LoadUVMask(), args.coverage, args.max_error, args.min_gain)
+    frames = ArrivingFrames(GetInputIndices(), idleTimeout=args.idle_timeout) if args.follow else None
+    outTex = GetSummedTexture(accumulator, frames, args.restart, workers, args.preview)
+    outTex = FillAtlasHoles(outTex, accumulator.known(), args.fill).astype(np.float64)
+    # parts never seen at all
     outTex = FillWithDominantColor(outTex)
     uvMask = cv2.imread('../../../Assets/SMPL/Samples/Materials/UVMask.png')
     outTex[np.where(uvMask == 0)] = 0
@@ -29,19 +29,37 @@ import tensorflow as tf
 from src.util import renderer as vis_util
 from src.util import image as img_util
 from src.util import openpose as op_util
+from src.util.animation import AnimationWriter, read_animation, write_animation
+from src.util.smoothing import smooth_animation
 import src.config
 from src.RunModel import RunModel
-from src.tf_smpl.batch_lbs import batch_rodrigues
+from src.np_smpl.batch_lbs import batch_rodrigues
 
 import skvideo.io
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import json
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AlphaPosePytorch'))
+from framestore import FrameStore
+from checkpoint import StageManifest, hashItems
 
 flags.DEFINE_string('img_path', 'data/im1963.jpg', 'Image to run')
 flags.DEFINE_string(
     'json_path', None,
     'If specified, uses the openpose output to crop the image.')
+flags.DEFINE_integer('video_batch_size', 16,
+                     'Number of frames per model.predict call in video mode')
+flags.DEFINE_integer('smooth_window', 5,
+                     'Savitzky-Golay window (in sampled frames) applied to the video poses, < 3 to disable')
+flags.DEFINE_integer('smooth_order', 2, 'Savitzky-Golay polynomial order')
+flags.DEFINE_boolean('upsample', False,
+                     'SLERP the video poses back to every frame of the source video')
+flags.DEFINE_integer('frame_stride', 1,
+                     'Source frames between two AlphaPose frames, only used without a frame store')
+flags.DEFINE_boolean('restart', False,
+                     'Ignore the checkpoint manifest of results/ and run the model on every frame again')
 
 ###
 def cart2sph(points):
@@ -69,6 +87,16 @@ def createRotMatrix(axis, theta):
                   [2*(b*c+a*d), a*a+c*c-b*b-d*d, 2*(c*d-a*b)],
                   [2*(b*d-a*c), 2*(c*d+a*b), a*a+d*d-b*b-c*c]])
 
+###
+def createRotMatrices(axes, thetas):
+    # createRotMatrix for n axes (n, 3) and angles (n,)
+    axes = axes / np.linalg.norm(axes, axis=1)[:,None]
+    a = np.cos(thetas/2.0)
+    b, c, d = (-axes*np.sin(thetas/2.0)[:,None]).T
+    return np.stack([np.stack([a*a+b*b-c*c-d*d, 2*(b*c-a*d), 2*(b*d+a*c)], axis=-1),
+                     np.stack([2*(b*c+a*d), a*a+c*c-b*b-d*d, 2*(c*d-a*b)], axis=-1),
+                     np.stack([2*(b*d-a*c), 2*(c*d+a*b), a*a+d*d-b*b-c*c], axis=-1)], axis=1)
+
 ###
 def rotate(points, R) :
     return np.dot(R, points.T).T
@@ -151,17 +179,15 @@ def quaternions_from_matrices(rotMatrices) :
     return np.column_stack((x,y,z,w))
 
 ###
-def save_poseshape(sess, outJSONPath, theta, pelvis, totalR) :
-    poseshape = {}
-    poseshape['translation'] = (pelvis * np.array([-1,1,1])).tolist()
-    Rs = tf.reshape(batch_rodrigues(tf.reshape(theta[3:-10], [-1, 3])), [-1, 24, 3, 3])
-    numpyRs = Rs.eval(session=sess)[0]
-    numpyRs[0] = combineRotations(numpyRs[0], totalR)
-    quaternions = quaternions_from_matrices(numpyRs)
-    poseshape['pose'] = quaternions.tolist()
-    poseshape['shape'] = theta[-10:].tolist()
-    with open(outJSONPath, 'w') as f:
-        json.dump(poseshape, f)
+def save_poseshapes(animation, frameNumbers, thetas, pelvises, totalRs) :
+    # Rodrigues and quaternions for all frames at once, in NumPy, so that
+    # nothing is added to the TF graph per frame
+    numFrames = len(thetas)
+    Rs = batch_rodrigues(thetas[:,3:-10].reshape(-1, 3)).reshape(numFrames, 24, 3, 3)
+    Rs[:,0] = np.matmul(totalRs, Rs[:,0])
+    quaternions = quaternions_from_matrices(Rs.reshape(-1, 3, 3)).reshape(numFrames, 24, 4)
+    translations = pelvises * np.array([-1,1,1])
+    animation.append(frameNumbers, translations, quaternions, thetas[:,-10:])
 
 ###
 def preprocess_image(img, json_path=None):
@@ -190,39 +216,69 @@ def getRotForFrame(video_folder, frame_number) :
         return rot
 
 ###
-def process_image(sess, outJSONPath, img, model, rot, json_path=None) :
-    input_img, proc_param, img = preprocess_image(img, json_path)
-    input_img = np.expand_dims(input_img, 0)
-    joints, verts, cams, joints3d, theta = model.predict(
-        input_img, get_theta=True)
-    joints, verts, theta, cam = joints[0], verts[0], theta[0], cams[0]
-    img_size = proc_param['img_size']
-    undo_scale = 1. / np.array(proc_param['scale'])
-    cam_s = cam[0]
-    cam_pos = cam[1:]
+def process_images(imgs, model, rots, json_path=None, animation=None, frameNumbers=None) :
+    # one model.predict for the whole batch, the rest is vectorized over frames
+    preprocessed = [preprocess_image(img, json_path) for img in imgs]
+    input_imgs = np.stack([p[0] for p in preprocessed])
+    joints, verts, cams, joints3d, thetas = model.predict(
+        input_imgs, get_theta=True)
+    rots = np.array(rots, dtype=np.float64).reshape(-1, 3)
+    img_size = preprocessed[0][1]['img_size']
+    undo_scale = 1. / np.array([p[1]['scale'] for p in preprocessed], dtype=np.float64)
+    start_pts = np.array([p[1]['start_pt'] for p in preprocessed], dtype=np.float64)
+    cam_s = cams[:,0]
+    cam_pos = cams[:,1:]
     principal_pt = np.array([img_size, img_size]) / 2.
-    flength = rot[0]
+    flength = rots[:,0]
     tz = flength / (0.5 * img_size * cam_s * undo_scale)
-    trans = np.hstack([cam_pos, tz])
-    vert_shifted = verts + trans
+    trans = np.column_stack([cam_pos, tz])
+    vert_shifted = verts + trans[:,None,:]
     RAxisSwitch = createRotMatrix(np.array([0,0,1]), np.pi)
-    RTheta = createRotMatrix(np.array([0,1,0]), rot[1])
-    rotPhiAxis = rotate(np.array([1,0,0]), RTheta)
-    RPhi = createRotMatrix(rotPhiAxis, rot[2])
-    RCombined = combineRotations(RAxisSwitch, combineRotations(RTheta, RPhi))
-    omni_vert = rotate(vert_shifted, RCombined)
-    joints_shifted = joints3d[0] + trans
-    omni_joints = rotate(joints_shifted, RCombined)
-    omni_pelvis = (omni_joints[2] + omni_joints[3])/2
-    start_pt = proc_param['start_pt'] - 0.5 * img_size
-    final_principal_pt = (principal_pt + start_pt) * undo_scale
-    cam_for_render = np.hstack([np.mean(flength), final_principal_pt])
+    RTheta = createRotMatrices(np.tile([0,1,0], (len(rots), 1)), rots[:,1])
+    rotPhiAxis = RTheta[:,:,0]
+    RPhi = createRotMatrices(rotPhiAxis, rots[:,2])
+    RCombined = np.matmul(np.matmul(RPhi, RTheta), RAxisSwitch)
+    omni_vert = np.matmul(vert_shifted, RCombined.transpose(0,2,1))
+    joints_shifted = joints3d + trans[:,None,:]
+    omni_joints = np.matmul(joints_shifted, RCombined.transpose(0,2,1))
+    omni_pelvis = (omni_joints[:,2] + omni_joints[:,3])/2
+    start_pt = start_pts - 0.5 * img_size
+    final_principal_pt = (principal_pt + start_pt) * undo_scale[:,None]
+    cam_for_render = np.column_stack([flength, final_principal_pt])
     margin = int(img_size / 2)
-    joints_orig = (joints + proc_param['start_pt'] - margin) * undo_scale
-    if outJSONPath != None :
-        save_poseshape(sess, outJSONPath, theta, omni_pelvis, RCombined)
+    joints_orig = (joints + start_pts[:,None,:] - margin) * undo_scale[:,None,None]
+    if animation != None :
+        save_poseshapes(animation, frameNumbers, thetas, omni_pelvis, RCombined)
     return cam_for_render, vert_shifted, omni_vert, joints_orig
 
+###
+def process_image(img, model, rot, json_path=None) :
+    cam_for_render, vert_shifted, omni_vert, joints_orig = process_images([img], model, [rot], json_path)
+    return cam_for_render[0], vert_shifted[0], omni_vert[0], joints_orig[0]
+
+###
+def batches(iterable, size) :
+    batch = []
+    for item in iterable :
+        batch.append(item)
+        if len(batch) == size :
+            yield batch
+            batch = []
+    if batch :
+        yield batch
+
+###
+def previous_records(path) :
+    # frame number -> (translation, quaternions, shape) of an earlier animation_raw.bin
+    if not os.path.exists(path) :
+        return {}
+    try :
+        animation = read_animation(path)
+    except ValueError :
+        return {}
+    return dict((int(frame), (np.array(t), np.array(q), np.array(s))) for frame, t, q, s in
+                zip(animation['frames'], animation['translation'], animation['pose'], animation['shape']))
+
 ###
 def main(img_path, is_video, json_path=None):
     sess = tf.Session()
@@ -237,22 +293,57 @@ def main(img_path, is_video, json_path=None):
         for frame in omnivideogen :
             omniimg = frame
             break
-        video_path = video_folder + 'ThirdParty/AlphaPosePytorch/results/AlphaPose_extractedFramesVideo.avi'
-        frame_number = 0
-        videogen = skvideo.io.vreader(video_path)
-        for frame in videogen :
-            outJSONPath = 'results/' + str(frame_number) + '.json'
-            rot = getRotForFrame(video_folder, frame_number)
-            cam_for_render, vert_shifted, omni_vert, joints_orig = process_image(sess, outJSONPath, frame, model, rot, json_path)
-            #if frame_number==0 :
-            #    ax3Dscale = scale3Dplot(axs[3], omni_vert, np.degrees(rot))
-            #visualize(frame, omniimg, cam_for_render, vert_shifted, omni_vert, joints_orig, axs, ax3Dscale, 1)
-            print('Finished processing frame %d' % frame_number)
-            frame_number += 1
+        store_path = video_folder + 'ThirdParty/AlphaPosePytorch/results/framestore'
+        if FrameStore.exists(store_path) :
+            # lossless crops and their camera rotations, memory-mapped
+            store = FrameStore(store_path)
+            videogen = ((store.sourceFrame(i), frame[:,:,::-1], store.cameraRot(i)) for i, frame in store.frames())
+        else :
+            video_path = video_folder + 'ThirdParty/AlphaPosePytorch/results/AlphaPose_inputVideo.avi'
+            videogen = ((i * config.frame_stride, frame, getRotForFrame(video_folder, i)) for i, frame in enumerate(skvideo.io.vreader(video_path)))
+        # the whole clip goes to one binary file, appended batch by batch,
+        # then gets smoothed over time into results/animation.bin.
+        # Frames checkpointed with the same crop and rotation are copied from
+        # the previous file instead of going through the model again.
+        manifest = StageManifest('results', 'hmr', {'load_path': config.load_path, 'img_size': config.img_size},
+                                 restart=config.restart)
+        previous = previous_records('results/animation_raw.bin')
+        animation = AnimationWriter('results/animation_raw.bin')
+        reused = 0
+        for batch in batches(videogen, config.batch_size) :
+            frame_numbers, frames, rots = zip(*batch)
+            hashes = [hashItems(frame, rot) for frame, rot in zip(frames, rots)]
+            done = [manifest.isDone(n, h) and n in previous for n, h in zip(frame_numbers, hashes)]
+            todo = [k for k in range(len(batch)) if not done[k]]
+            if todo :
+                process_images([frames[k] for k in todo], model, [rots[k] for k in todo], json_path, animation,
+                               [frame_numbers[k] for k in todo])
+            for k in range(len(batch)) :
+                if done[k] :
+                    translation, quaternions, shape = previous[frame_numbers[k]]
+                    animation.append([frame_numbers[k]], translation[None], quaternions[None], shape[None])
+                    reused += 1
+                else :
+                    manifest.record(frame_numbers[k], hashes[k], ['animation_raw.bin'])
+            #if frame_numbers[0]==0 :
+            #    ax3Dscale = scale3Dplot(axs[3], omni_vert[0], np.degrees(rots[0]))
+            #visualize(frames[0], omniimg, cam_for_render[0], vert_shifted[0], omni_vert[0], joints_orig[0], axs, ax3Dscale, 1)
+            print('Finished processing frames %d to %d' % (frame_numbers[0], frame_numbers[-1]))
+        animation.close()
+        manifest.markComplete()
+        manifest.close()
+        print('Reused %d checkpointed frames.' % reused)
+        # reused and new frames are appended out of order within a batch
+        raw = read_animation('results/animation_raw.bin')
+        order = np.argsort(raw['frames'], kind='mergesort')
+        raw = dict((key, np.asarray(value)[order]) for key, value in raw.items())
+        frames, translations, quaternions, shapes = smooth_animation(
+            raw, config.smooth_window, config.smooth_order, config.upsample)
+        write_animation('results/animation.bin', frames, translations, quaternions, shapes)
         return    
 
     img = io.imread(img_path)
-    cam_for_render, vert_shifted, omni_vert, joints_orig = process_image(sess, None, img, model, (500,0,0), json_path)
+    cam_for_render, vert_shifted, omni_vert, joints_orig = process_image(img, model, (500,0,0), json_path)
     ax3Dscale = scale3Dplot(axs[3], vert_shifted, (0,0,0))
     visualize(img, img, cam_for_render, vert_shifted, vert_shifted, joints_orig, axs, ax3Dscale, 1000)
 
@@ -261,8 +352,8 @@ if __name__ == '__main__':
     config = flags.FLAGS
     config(sys.argv)
     config.load_path = src.config.PRETRAINED_MODEL
-    config.batch_size = 1
     is_video = False
     if config.img_path=='video' :
         is_video = True
+    config.batch_size = config.video_batch_size if is_video else 1
     main(config.img_path, is_video, config.json_path)
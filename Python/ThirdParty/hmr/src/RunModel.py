@@ -150,7 +150,13 @@ class RunModel(object):
         images: num_batch, img_size, img_size, 3
         Preprocessed to range [-1, 1]
         Runs the model with images.
+        A batch smaller than batch_size (e.g. the end of a video) is
+        zero-padded to fit the placeholder and the padding is dropped.
         """
+        num_images = images.shape[0]
+        if num_images < self.batch_size:
+            padding = np.zeros((self.batch_size - num_images,) + images.shape[1:], dtype=images.dtype)
+            images = np.concatenate((images, padding), axis=0)
         feed_dict = {
             self.images_pl: images,
             # self.theta0_pl: self.mean_var,
@@ -164,6 +170,8 @@ class RunModel(object):
         }
 
         results = self.sess.run(fetch_dict, feed_dict)
+        for key in results:
+            results[key] = results[key][:num_images]
 
         # Return joints in original image space.
         joints = results['joints']
@@ -0,0 +1,96 @@
+""" NumPy versions of the util functions in tf_smpl.batch_lbs
+@@batch_skew
+@@batch_rodrigues
+@@batch_global_rigid_transformation
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def batch_skew(vec):
+    """
+    vec is N x 3
+
+    returns N x 3 x 3. Skew_sym version of each matrix.
+    """
+    res = np.zeros((vec.shape[0], 3, 3), dtype=vec.dtype)
+    res[:, 0, 1] = -vec[:, 2]
+    res[:, 0, 2] = vec[:, 1]
+    res[:, 1, 0] = vec[:, 2]
+    res[:, 1, 2] = -vec[:, 0]
+    res[:, 2, 0] = -vec[:, 1]
+    res[:, 2, 1] = vec[:, 0]
+    return res
+
+
+def batch_rodrigues(theta):
+    """
+    Theta is N x 3, same conventions (and epsilon) as tf_smpl.batch_rodrigues.
+
+    returns N x 3 x 3 rotation matrices.
+    """
+    theta = np.asarray(theta)
+    angle = np.linalg.norm(theta + 1e-8, axis=1)[:, None]
+    r = theta / angle
+
+    angle = angle[:, :, None]
+    cos = np.cos(angle)
+    sin = np.sin(angle)
+
+    outer = r[:, :, None] * r[:, None, :]
+
+    R = cos * np.eye(3, dtype=theta.dtype) + (1 - cos) * outer + sin * batch_skew(r)
+    return R
+
+
+def batch_global_rigid_transformation(Rs, Js, parent, rotate_base=False):
+    """
+    Computes absolute joint locations given pose.
+
+    rotate_base: if True, rotates the global rotation by 90 deg in x axis.
+    if False, this is the original SMPL coordinate.
+
+    Args:
+      Rs: N x 24 x 3 x 3 rotation vector of K joints
+      Js: N x 24 x 3, joint locations before posing
+      parent: 24 holding the parent id for each index
+
+    Returns
+      new_J : N x 24 x 3 location of absolute joints
+      A     : N x 24 4 x 4 relative joint transformations for LBS.
+    """
+    N, K = Js.shape[:2]
+    if rotate_base:
+        rot_x = np.array([[1, 0, 0], [0, -1, 0], [0, 0, -1]], dtype=Rs.dtype)
+        root_rotation = np.matmul(Rs[:, 0], rot_x)
+    else:
+        root_rotation = Rs[:, 0]
+
+    # Local transforms, the root one is absolute
+    local = np.zeros((N, K, 4, 4), dtype=Rs.dtype)
+    local[:, :, :3, :3] = Rs
+    local[:, 0, :3, :3] = root_rotation
+    local[:, 0, :3, 3] = Js[:, 0]
+    local[:, 1:, :3, 3] = Js[:, 1:] - Js[:, parent[1:]]
+    local[:, :, 3, 3] = 1
+
+    # Chain them down the kinematic tree, parents always come first
+    results = np.empty_like(local)
+    results[:, 0] = local[:, 0]
+    for i in range(1, K):
+        np.matmul(results[:, parent[i]], local[:, i], out=results[:, i])
+
+    new_J = results[:, :, :3, 3].copy()
+
+    # --- Compute relative A: Skinning is based on
+    # how much the bone moved (not the final location of the bone)
+    # but (final_bone - init_bone)
+    # ---
+    A = results
+    A[:, :, :3, 3] -= np.matmul(results[:, :, :3, :3], Js[:, :, :, None])[:, :, :, 0]
+
+    return new_J, A
@@ -0,0 +1,172 @@
+"""
+NumPy SMPL implementation as batch, mirrors tf_smpl.batch_smpl.SMPL
+without needing a TensorFlow session.
+Specify joint types:
+'coco': Returns COCO+ 19 joints
+'lsp': Returns H3.6M-LSP 14 joints
+Note: To get original smpl joints, use self.J_transformed
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse as sp
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .batch_lbs import batch_rodrigues, batch_global_rigid_transformation
+
+
+# There are chumpy variables so convert them to numpy.
+def undo_chumpy(x):
+    return x if isinstance(x, np.ndarray) else x.r
+
+
+def load_pkl(pkl_path):
+    with open(pkl_path, 'rb') as f:
+        try:
+            return pickle.load(f, encoding='latin1')
+        except TypeError:
+            # Python 2 pickle.load has no encoding argument
+            return pickle.load(f)
+
+
+class SMPL(object):
+    def __init__(self, pkl_path, joint_type='cocoplus', dtype=np.float32):
+        """
+        pkl_path is the path to a SMPL model (or the already loaded dict)
+        """
+        # -- Load SMPL params --
+        dd = load_pkl(pkl_path) if isinstance(pkl_path, str) else pkl_path
+        self.dtype = dtype
+        # Vertex arrays are kept coordinate-major (3 x 6890) so that the
+        # skinning works on contiguous rows, outputs are transposed back.
+        # Mean template vertices
+        self.v_template = np.ascontiguousarray(undo_chumpy(dd['v_template']).T, dtype=dtype)
+        # Size of mesh [Number of vertices, 3]
+        self.size = [self.v_template.shape[1], 3]
+        self.num_betas = dd['shapedirs'].shape[-1]
+        # Shape blend shape basis: 6980 x 3 x 10
+        # reordered to 3 x 6980 x 10, reshaped to 3*6980 x 10, transposed
+        self.shapedirs = np.ascontiguousarray(np.reshape(
+            undo_chumpy(dd['shapedirs']).transpose(1, 0, 2), [-1, self.num_betas]).T, dtype=dtype)
+
+        # Regressor for joint locations given shape - 24 x 6890, kept sparse
+        self.J_regressor = sp.csr_matrix(dd['J_regressor'], dtype=dtype)
+
+        # Pose blend shape basis: 6890 x 3 x 207, reordered to 3*6890 x 207
+        num_pose_basis = dd['posedirs'].shape[-1]
+        # 207 x 20670
+        self.posedirs = np.ascontiguousarray(np.reshape(
+            undo_chumpy(dd['posedirs']).transpose(1, 0, 2), [-1, num_pose_basis]).T, dtype=dtype)
+
+        # indices of parents for each joints
+        self.parents = dd['kintree_table'][0].astype(np.int32)
+
+        # LBS weights, transposed to 24 x 6890
+        self.weights = np.ascontiguousarray(undo_chumpy(dd['weights']).T, dtype=dtype)
+
+        # This returns 19 keypoints: 19 x 6890, kept sparse
+        self.joint_regressor = sp.csr_matrix(dd['cocoplus_regressor'], dtype=dtype)
+        if joint_type == 'lsp':  # 14 LSP joints!
+            self.joint_regressor = self.joint_regressor[:14]
+
+        if joint_type not in ['cocoplus', 'lsp']:
+            raise ValueError('Unknown joint type: %s, it must be either "cocoplus" or "lsp"' % joint_type)
+
+        self.eye = np.eye(3, dtype=dtype)
+        self.capacity = 0
+        self.J_transformed = None
+
+    def allocate(self, num_batch):
+        # work buffers, grown to the largest batch seen and reused afterwards
+        if num_batch <= self.capacity:
+            return
+        num_verts = self.size[0]
+        self.v_shaped_buf = np.empty((num_batch, num_verts * 3), dtype=self.dtype)
+        self.v_posed_buf = np.empty((num_batch, num_verts * 3), dtype=self.dtype)
+        self.T_buf = np.empty((num_batch, 4, 3, num_verts), dtype=self.dtype)
+        self.verts_buf = np.empty((num_batch, 3, num_verts), dtype=self.dtype)
+        self.tmp_buf = np.empty((num_batch, num_verts), dtype=self.dtype)
+        self.capacity = num_batch
+
+    def regress(self, regressor, verts):
+        # sparse (K x V) regressor applied to N x 3 x V vertices -> N x K x 3
+        N, _, V = verts.shape
+        flat = np.ascontiguousarray(verts.reshape(N * 3, V).T)
+        return np.asarray(regressor.dot(flat)).T.reshape(N, 3, -1).transpose(0, 2, 1)
+
+    def __call__(self, beta, theta, get_skin=False):
+        """
+        Obtain SMPL with shape (beta) & pose (theta) inputs.
+        Theta includes the global rotation.
+        Args:
+          beta: N x 10
+          theta: N x 72 (with 3-D axis-angle rep)
+
+        Updates:
+        self.J_transformed: N x 24 x 3 joint location after shaping
+                 & posing with beta and theta
+        Returns:
+          - joints: N x 19 or 14 x 3 joint locations depending on joint_type
+        If get_skin is True, also returns
+          - Verts: N x 6980 x 3
+          - Rs: N x 24 x 3 x 3
+        The returned vertices are a view into a work buffer that is
+        overwritten by the next call, copy them to keep them.
+        """
+        beta = np.asarray(beta, dtype=self.dtype)
+        theta = np.asarray(theta, dtype=self.dtype)
+        num_batch = beta.shape[0]
+        self.allocate(num_batch)
+
+        # 1. Add shape blend shapes
+        # (N x 10) x (10 x 3*6890) = N x 3 x 6890
+        v_shaped = self.v_shaped_buf[:num_batch]
+        np.dot(beta, self.shapedirs, out=v_shaped)
+        v_shaped = v_shaped.reshape(num_batch, self.size[1], self.size[0])
+        v_shaped += self.v_template
+
+        # 2. Infer shape-dependent joint locations.
+        J = self.regress(self.J_regressor, v_shaped)
+
+        # 3. Add pose blend shapes
+        # N x 24 x 3 x 3
+        Rs = batch_rodrigues(theta.reshape(-1, 3)).reshape(num_batch, 24, 3, 3)
+        # Ignore global rotation.
+        pose_feature = (Rs[:, 1:, :, :] - self.eye).reshape(num_batch, 207)
+
+        # (N x 207) x (207, 20670) -> N x 3 x 6890
+        v_posed = self.v_posed_buf[:num_batch]
+        np.dot(pose_feature, self.posedirs, out=v_posed)
+        v_posed = v_posed.reshape(num_batch, self.size[1], self.size[0])
+        v_posed += v_shaped
+
+        #4. Get the global joint location
+        self.J_transformed, A = batch_global_rigid_transformation(Rs, J, self.parents)
+
+        # 5. Do skinning:
+        # Only the top 3 rows of A matter, columns first: N x 12 x 24
+        A = np.ascontiguousarray(A[:, :, :3, :].transpose(0, 3, 2, 1)).reshape(num_batch, 12, 24)
+        # (N x 12 x 24) x (24 x 6890) -> N x 4 x 3 x 6890, T[:, j, i] = T_ij
+        T = self.T_buf[:num_batch]
+        np.matmul(A, self.weights, out=T.reshape(num_batch, 12, self.size[0]))
+        verts = self.verts_buf[:num_batch]
+        tmp = self.tmp_buf[:num_batch]
+        np.copyto(verts, T[:, 3])
+        for j in range(3):
+            for i in range(3):
+                np.multiply(T[:, j, i], v_posed[:, j], out=tmp)
+                verts[:, i] += tmp
+
+        # Get cocoplus or lsp joints:
+        joints = self.regress(self.joint_regressor, verts)
+
+        if get_skin:
+            return verts.transpose(0, 2, 1), joints, Rs
+        else:
+            return joints
@@ -0,0 +1,100 @@
+"""
+Binary animation file written by demo.py and read by CreateAnimation.cs.
+
+Little-endian layout:
+  header (32 bytes): magic 'HMRA', uint32 version, uint32 number of frames,
+                     uint32 number of joints, uint32 number of betas, 12 reserved bytes
+  one float32 record per frame:
+                     source frame index, translation (3),
+                     joint quaternions (joints x 4, x y z w), shape (betas)
+
+Records are frame-major so that frames can be appended while HMR runs,
+the frame count in the header is updated with every append.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import struct
+
+import numpy as np
+
+MAGIC = b'HMRA'
+VERSION = 1
+HEADER = struct.Struct('<4sIIII12x')
+
+
+def record_size(num_joints, num_betas):
+    return 1 + 3 + 4 * num_joints + num_betas
+
+
+class AnimationWriter(object):
+    def __init__(self, path, num_joints=24, num_betas=10):
+        self.path = path
+        self.num_joints = num_joints
+        self.num_betas = num_betas
+        self.num_frames = 0
+        self.f = open(path, 'wb')
+        self.write_header()
+
+    def write_header(self):
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, self.num_frames, self.num_joints, self.num_betas))
+        self.f.flush()
+
+    def append(self, frames, translations, quaternions, shapes):
+        """
+        frames: N source frame indices
+        translations: N x 3
+        quaternions: N x joints x 4
+        shapes: N x betas
+        """
+        n = len(frames)
+        records = np.empty((n, record_size(self.num_joints, self.num_betas)), dtype='<f4')
+        records[:, 0] = frames
+        records[:, 1:4] = translations
+        records[:, 4:4 + 4 * self.num_joints] = np.reshape(quaternions, (n, -1))
+        records[:, 4 + 4 * self.num_joints:] = shapes
+        self.f.seek(0, 2)
+        self.f.write(records.tobytes())
+        self.num_frames += n
+        self.write_header()
+
+    def close(self):
+        if not self.f.closed:
+            self.write_header()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_animation(path, frames, translations, quaternions, shapes):
+    with AnimationWriter(path, quaternions.shape[1], shapes.shape[1]) as writer:
+        writer.append(frames, translations, quaternions, shapes)
+
+
+def read_animation(path):
+    """
+    Returns a dict of arrays: frames (N,), translation (N x 3),
+    pose (N x joints x 4) and shape (N x betas), as views into the memory-mapped file.
+    """
+    with open(path, 'rb') as f:
+        magic, version, num_frames, num_joints, num_betas = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a version %d animation file' % (path, VERSION))
+    size = record_size(num_joints, num_betas)
+    if num_frames:
+        records = np.memmap(path, dtype='<f4', mode='r', offset=HEADER.size, shape=(num_frames, size))
+    else:
+        records = np.zeros((0, size), dtype='<f4')
+    return {
+        'frames': records[:, 0],
+        'translation': records[:, 1:4],
+        'pose': records[:, 4:4 + 4 * num_joints].reshape(num_frames, num_joints, 4),
+        'shape': records[:, 4 + 4 * num_joints:],
+    }
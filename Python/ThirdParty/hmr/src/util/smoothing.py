@@ -0,0 +1,178 @@
+"""
+Temporal post-processing of a whole clip of HMR poses:
+quaternion hemisphere continuity, Savitzky-Golay smoothing and
+SLERP resampling to the frames of the source video.
+All functions work on the arrays of util.animation.read_animation,
+time being the first axis.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def quaternion_continuity(quaternions):
+    """
+    Flips the sign of the quaternions (frames x ... x 4) so that every
+    quaternion is in the same hemisphere as the one of the previous frame.
+    """
+    q = np.array(quaternions, dtype=np.float64)
+    if len(q) < 2:
+        return q
+    flips = np.sum(q[1:] * q[:-1], axis=-1) < 0
+    # a flip at frame t applies to all the following frames
+    parity = np.cumsum(flips, axis=0) % 2
+    q[1:][parity == 1] *= -1
+    return q
+
+
+def savgol_coefficients(window, order, positions=None):
+    """
+    Least-squares polynomial fit of the given order over a centered window,
+    evaluated at the given positions (offsets from the center, default 0).
+    Returns positions x window weights.
+    """
+    half = window // 2
+    x = np.arange(-half, half + 1, dtype=np.float64)
+    A = np.vander(x, order + 1, increasing=True)
+    if positions is None:
+        positions = [0]
+    P = np.vander(np.asarray(positions, dtype=np.float64), order + 1, increasing=True)
+    return np.dot(P, np.linalg.pinv(A))
+
+
+def savgol_filter(data, window, order, times=None):
+    """
+    Savitzky-Golay filter along the first axis of data. The edges are
+    evaluated on the polynomial fitted to the first and last windows.
+    The window is reduced (and kept odd) for clips shorter than it.
+    times (increasing, one per sample) are the sample times when they
+    are not evenly spaced, see local_polynomial_filter.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    frames = len(data)
+    window = min(window, frames if frames % 2 else frames - 1)
+    if window < 3 or order >= window:
+        return data.copy()
+    if times is not None:
+        steps = np.diff(np.asarray(times, dtype=np.float64))
+        if not np.allclose(steps, steps[0]):
+            return local_polynomial_filter(data, times, window, order)
+    half = window // 2
+    out = np.empty_like(data)
+    center = savgol_coefficients(window, order)[0]
+    # weighted sum of shifted views, vectorized over all the other axes
+    out[half:frames - half] = 0
+    for k in range(window):
+        out[half:frames - half] += center[k] * data[k:frames - window + 1 + k]
+    edges = savgol_coefficients(window, order, np.arange(-half, 0))
+    out[:half] = np.tensordot(edges, data[:window], axes=1)
+    edges = savgol_coefficients(window, order, np.arange(1, half + 1))
+    out[frames - half:] = np.tensordot(edges, data[frames - window:], axes=1)
+    return out
+
+
+def local_polynomial_filter(data, times, window, order):
+    """
+    Savitzky-Golay filter of unevenly spaced samples: the polynomial of
+    every window is fitted against the sample times instead of the sample
+    indices, and evaluated at the time of its sample. Same windows as
+    savgol_filter, which it matches on evenly spaced times.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    frames = len(data)
+    half = window // 2
+    starts = np.clip(np.arange(frames) - half, 0, frames - window)
+    idx = starts[:, None] + np.arange(window)
+    x = times[idx] - times[:, None]
+    # scaled to [-1, 1] for the conditioning of the fit
+    x /= np.abs(x).max(axis=1, keepdims=True)
+    A = x[:, :, None] ** np.arange(order + 1)
+    # constant term of the fit, the value at the time of the sample
+    weights = np.linalg.pinv(A)[:, 0, :]
+    return np.einsum('fw,fw...->f...', weights, data[idx])
+
+
+def smooth_quaternions(quaternions, window, order, times=None):
+    q = savgol_filter(quaternion_continuity(quaternions), window, order, times)
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def slerp(q0, q1, t):
+    """
+    Spherical linear interpolation between quaternions q0 and q1 (... x 4)
+    at t (broadcast against q0[..., 0]).
+    """
+    t = np.asarray(t, dtype=np.float64)[..., None]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.clip(np.abs(dot), 0.0, 1.0)
+    angle = np.arccos(dot)
+    sin = np.sin(angle)
+    # fall back to normalized lerp where the quaternions are almost equal
+    close = sin < 1e-6
+    safe = np.where(close, 1.0, sin)
+    w0 = np.where(close, 1 - t, np.sin((1 - t) * angle) / safe)
+    w1 = np.where(close, t, np.sin(t * angle) / safe)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def resample(frames, target_frames, quaternions, translations, shapes):
+    """
+    Interpolates the poses sampled at frames (increasing) at target_frames,
+    SLERP for the quaternions and linear for translations and shapes.
+    Targets outside of the sampled range are clamped to the first/last pose.
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    target_frames = np.asarray(target_frames, dtype=np.float64)
+    if len(frames) < 2:
+        idx = np.zeros(len(target_frames), dtype=int)
+        return quaternions[idx], translations[idx], shapes[idx]
+    i = np.clip(np.searchsorted(frames, target_frames, side='right') - 1, 0, len(frames) - 2)
+    t = np.clip((target_frames - frames[i]) / (frames[i + 1] - frames[i]), 0.0, 1.0)
+    q = slerp(quaternions[i], quaternions[i + 1], t.reshape((-1,) + (1,) * (quaternions.ndim - 2)))
+    lerp = lambda a: a[i] + t.reshape((-1,) + (1,) * (a.ndim - 1)) * (a[i + 1] - a[i])
+    return q, lerp(translations), lerp(shapes)
+
+
+def smooth_animation(animation, window=5, order=2, upsample=False):
+    """
+    animation: dict from util.animation.read_animation
+    Returns frames, translations, quaternions and shapes after continuity,
+    smoothing (window < 3 disables it) and optionally upsampling to every
+    source frame between the first and the last sampled one.
+    The polynomials are fitted against the source frame of every pose, so
+    adaptively sampled (unevenly spaced) frames are smoothed in time.
+    """
+    frames = np.asarray(animation['frames'], dtype=np.float64)
+    quaternions = smooth_quaternions(animation['pose'], window, order, frames)
+    translations = savgol_filter(animation['translation'], window, order, frames)
+    shapes = np.array(animation['shape'], dtype=np.float64)
+    if upsample and len(frames) > 1:
+        target_frames = np.arange(frames[0], frames[-1] + 1)
+        quaternions, translations, shapes = resample(frames, target_frames, quaternions, translations, shapes)
+        frames = target_frames
+    return frames, translations, quaternions, shapes
+
+
+def check_uneven_smoothing(seed=0):
+    """
+    Smoothing of unevenly spaced frames: a quadratic motion is kept as is
+    (the fit over sample indices bends it), and evenly spaced times give
+    the plain Savitzky-Golay filter.
+    """
+    rng = np.random.RandomState(seed)
+    frames = np.cumsum(rng.choice([1, 2, 5, 30], 60)).astype(np.float64)
+    motion = np.stack([0.01 * frames ** 2 - frames, 3 * frames], axis=1)
+    exact = np.allclose(savgol_filter(motion, 7, 2, frames), motion)
+    by_index = np.allclose(savgol_filter(motion, 7, 2), motion)
+    data = rng.normal(size=(60, 3, 4))
+    even = np.allclose(local_polynomial_filter(data, np.arange(60) * 10.0, 7, 2), savgol_filter(data, 7, 2))
+    return exact and not by_index and even
+
+
+if __name__ == '__main__':
+    print('uneven frames: %s' % ('ok' if check_uneven_smoothing() else 'FAILED'))